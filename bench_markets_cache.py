@@ -0,0 +1,59 @@
+import os
+import time
+import argparse
+import ccxt
+
+import markets_cache
+
+# Local benchmark: time until a bybit client has its markets, straight from the
+# exchange (cold) vs from the on-disk snapshot (warm). Needs network access for the cold runs.
+
+
+def make_client(testnet):
+    client = ccxt.bybit({'enableRateLimit': True})
+    if testnet:
+        client.set_sandbox_mode(True)
+    return client
+
+
+def measure(name, func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    print(f"{name:<36} min={times[0]:9.2f}ms median={times[len(times) // 2]:9.2f}ms max={times[-1]:9.2f}ms")
+
+
+def cold(testnet):
+    client = make_client(testnet)
+    path = markets_cache.cache_path(markets_cache.cache_key(client))
+    if os.path.exists(path):
+        os.remove(path)
+    markets_cache.memory.clear()
+    markets_cache.load_markets(client)
+
+
+def warm_process(testnet):
+    # First client of a new process: the snapshot is read from disk
+    markets_cache.memory.clear()
+    markets_cache.load_markets(make_client(testnet))
+
+
+def warm_memory(testnet):
+    # Further clients of the same process reuse the snapshot already read
+    markets_cache.load_markets(make_client(testnet))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark client-ready time with the markets cache cold and warm.")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--mainnet', action='store_true')
+    args = parser.parse_args()
+    testnet = not args.mainnet
+
+    measure("plain load_markets (no cache)", lambda: make_client(testnet).load_markets(), args.runs)
+    measure("cold cache (fetch + write)", lambda: cold(testnet), args.runs)
+    measure("warm cache, new process", lambda: warm_process(testnet), args.runs * 10)
+    measure("warm cache, same process", lambda: warm_memory(testnet), args.runs * 10)
@@ -0,0 +1,75 @@
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+from mongoengine import connect
+
+import queue_service
+from queue_service import Message
+
+# Local benchmark: dispatcher and trade.py pending-work queries against a large message history,
+# with and without the (status, bot_id, timestamp) index. Uses its own database.
+BENCH_DB = 'trade_db_bench'
+
+
+def seed(collection, history, pending, bots):
+    now = datetime.utcnow()
+    commands = ["enter-long", "enter-short", "exit-long", "exit-short", "take-profit-long-2"]
+    batch = []
+    for i in range(history + pending):
+        batch.append({
+            'bot_id': str(random.randint(1, bots)),
+            'pair': "BTC/USDT",
+            'command': random.choice(commands),
+            'percent': "none",
+            'timestamp': now - timedelta(seconds=random.randint(0, 90 * 24 * 3600)) if i < history else now,
+            'status': random.choice(["success", "failed"]) if i < history else "pending",
+        })
+        if len(batch) == 10000:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def measure(name, func, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    print(f"{name:<40} {(time.perf_counter() - start) / runs * 1000:9.2f} ms")
+
+
+def run_queries(runs):
+    measure("distinct bot_id (old dispatcher)",
+            lambda: Message.objects(status="pending").distinct(field="bot_id"), runs)
+    measure("pending_work aggregation",
+            queue_service.pending_work, runs)
+    measure("trade.py pending messages for one bot",
+            lambda: list(Message.objects(bot_id="1", status="pending").order_by('+timestamp', '+id')), runs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark pending-work queries.")
+    parser.add_argument('--history', type=int, default=1000000)
+    parser.add_argument('--pending', type=int, default=50)
+    parser.add_argument('--bots', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    client = connect(BENCH_DB)
+    client.drop_database(BENCH_DB)
+    collection = Message._get_collection()
+
+    print(f"Seeding {args.history} historical and {args.pending} pending messages...")
+    start = time.perf_counter()
+    seed(collection, args.history, args.pending, args.bots)
+    print(f"Seeded in {time.perf_counter() - start:.1f}s")
+
+    print("--- without indexes")
+    run_queries(args.runs)
+
+    Message.ensure_indexes()
+    print("--- with (status, bot_id, timestamp) index")
+    run_queries(args.runs)
+
+    client.drop_database(BENCH_DB)
@@ -0,0 +1,77 @@
+import re
+import sys
+import argparse
+import subprocess
+
+# Local benchmark: import time (-X importtime) and peak RSS of a fresh trade.py
+# process, against a budget. The legacy line imports pandas and all of ccxt first,
+# the way trade.py used to. Exits with 1 when the fast path is over budget.
+
+CHILD = """
+import sys
+{imports}
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+except ImportError:
+    try:
+        import psutil
+        rss = psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        rss = -1
+print(f"RSS {{rss}}", file=sys.stderr)
+"""
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def run(imports):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD.format(imports=imports)],
+                            capture_output=True, text=True, check=True)
+    total_us = 0
+    top = []
+    rss = -1.0
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            cumulative, indent, name = int(match.group(2)), len(match.group(3)), match.group(4)
+            if indent == 1:
+                total_us += cumulative
+                top.append((cumulative, name))
+        elif line.startswith("RSS "):
+            rss = float(line[4:])
+    return total_us / 1000, rss, sorted(top, reverse=True)[:5]
+
+
+def best_of(imports, runs):
+    results = [run(imports) for _ in range(runs)]
+    return min(results, key=lambda r: r[0])
+
+
+def report(name, result):
+    import_ms, rss, top = result
+    print(f"{name:<8} import={import_ms:8.1f}ms  peak_rss={rss:7.1f}MB  "
+          + ", ".join(f"{mod} {us / 1000:.0f}ms" for us, mod in top))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark trade.py startup cost.")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--import-budget-ms', type=float, default=450)
+    parser.add_argument('--rss-budget-mb', type=float, default=90)
+    args = parser.parse_args()
+
+    legacy = best_of("import pandas\nimport ccxt\nimport trade", args.runs)
+    fast = best_of("import trade", args.runs)
+    report("legacy", legacy)
+    report("fast", fast)
+
+    over = []
+    if fast[0] > args.import_budget_ms:
+        over.append(f"import time {fast[0]:.1f}ms > {args.import_budget_ms}ms")
+    if fast[1] > args.rss_budget_mb:
+        over.append(f"peak RSS {fast[1]:.1f}MB > {args.rss_budget_mb}MB")
+    if over:
+        print("OVER BUDGET: " + "; ".join(over))
+        sys.exit(1)
+    print(f"Within budget ({args.import_budget_ms}ms, {args.rss_budget_mb}MB).")
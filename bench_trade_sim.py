@@ -0,0 +1,86 @@
+import sys
+import time
+import argparse
+from mongoengine import connect
+
+import bybit_sim
+import trade
+from trade import Message
+from exchange_loader import point_at_simulator
+from call_timing import CallTimer
+import retry_policy
+
+# Local benchmark: trade.py against bybit_sim.py, no network or exchange account
+# needed. Each round queues one command per pair, runs the bot once and records
+# queue-to-finish latency per message and the REST calls it made. Same seed and
+# arguments give the same exchange behaviour, so runs can be compared before and
+# after a change. Uses its own database; exits with 1 when p95 is over budget.
+BENCH_DB = 'trade_db_bench'
+ROUNDS = ["enter-long", "take-profit-long-1", "exit-long", "enter-short", "exit-short"]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))] if values else 0.0
+
+
+def make_client(url, bot_id):
+    client = trade.bybit_class({'apiKey': f"bench-{bot_id}", 'secret': "bench", 'enableRateLimit': False})
+    point_at_simulator(client, url)
+    CallTimer(client)
+    retry_policy.ExchangePolicy(client, f"bench-{bot_id}", None)
+    return client
+
+
+def run(client, bot_id, pairs, cycles):
+    latencies = []
+    statuses = {}
+    calls = 0
+    for _ in range(cycles):
+        for command in ROUNDS:
+            batch = [Message(bot_id=bot_id, pair=pair, command=command).save() for pair in pairs]
+            trade.run_bot(bot_id, client)
+            for msg in batch:
+                msg.reload()
+                statuses[msg.status] = statuses.get(msg.status, 0) + 1
+                if msg.finished_at:
+                    latencies.append((msg.finished_at - msg.timestamp).total_seconds() * 1000)
+                calls += (msg.call_summary or {}).get('calls', 0)
+    return latencies, statuses, calls
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark trade.py against the local Bybit simulator.")
+    parser.add_argument('--bot', default='1', help="bot whose bots/<id>.ini settings are used")
+    parser.add_argument('--pairs', default="BTC/USDT,ETH/USDT,XRP/USDT")
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=30)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--errors', default='rate_limit')
+    parser.add_argument('--p95-budget-ms', type=float, default=0, help="0 to only report")
+    args = parser.parse_args()
+
+    client = connect(BENCH_DB)
+    client.drop_database(BENCH_DB)
+    trade.verbose = False
+
+    sim = bybit_sim.Simulator(seed=args.seed, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                              error_rate=args.error_rate, errors=args.errors.split(","))
+    server, url = bybit_sim.start(sim)
+    start = time.perf_counter()
+    latencies, statuses, calls = run(make_client(url, args.bot), args.bot, args.pairs.split(","), args.cycles)
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    print(f"messages={len(latencies)}  " + "  ".join(f"{k}={v}" for k, v in sorted(statuses.items())))
+    print(f"latency p50={percentile(latencies, 50):.1f}ms  p95={percentile(latencies, 95):.1f}ms  "
+          f"max={max(latencies, default=0):.1f}ms")
+    print(f"rest calls={calls} ({calls / max(len(latencies), 1):.1f}/message)  wall={elapsed:.2f}s")
+    top = sorted(((n, endpoint) for endpoint, n in sim.counts.items() if isinstance(endpoint, str)), reverse=True)
+    print("  ".join(f"{endpoint}={n}" for n, endpoint in top))
+
+    if args.p95_budget_ms and percentile(latencies, 95) > args.p95_budget_ms:
+        print(f"OVER BUDGET: p95 {percentile(latencies, 95):.1f}ms > {args.p95_budget_ms}ms")
+        sys.exit(1)
@@ -0,0 +1,77 @@
+import time
+import argparse
+from threading import Thread
+from mongoengine import connect, disconnect
+
+import webhook
+from ingest_buffer import IngestBuffer
+
+# Local benchmark: ack latency of the webhook handler, synchronous write vs buffered ingestion.
+# Writes into a separate database so a running queue service never sees the messages.
+BENCH_DB = 'trade_db_bench'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(requests, fanout, threads):
+    bot_ids = "&".join(str(i) for i in range(1, fanout + 1))
+    command = f"{bot_ids}_BTC/USDT_enter-long"
+    latencies = []
+
+    def client_thread(n):
+        client = webhook.app.test_client()
+        for _ in range(n):
+            start = time.perf_counter()
+            response = client.post('/webhook', data={'command': command})
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 200
+
+    workers = [Thread(target=client_thread, args=(requests // threads,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return latencies, time.perf_counter() - start
+
+
+def report(name, latencies, elapsed):
+    print(f"{name:<10} requests={len(latencies):<6} p50={percentile(latencies, 50):7.2f}ms "
+          f"p99={percentile(latencies, 99):7.2f}ms max={max(latencies):7.2f}ms "
+          f"throughput={len(latencies) / elapsed:8.1f} req/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark webhook ack latency.")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--flush-interval-ms', type=int, default=20)
+    args = parser.parse_args()
+
+    disconnect()
+    db = connect(BENCH_DB)
+    webhook.Message._collection = None
+    webhook.print = lambda *a, **k: None  # keep the console out of the measurement
+    webhook.dedupe_cache = None  # every benchmark request carries the same command
+
+    db.drop_database(BENCH_DB)
+    webhook.ingest_buffer = None
+    latencies, elapsed = run(args.requests, args.fanout, args.threads)
+    report("sync", latencies, elapsed)
+
+    db.drop_database(BENCH_DB)
+    webhook.ingest_buffer = IngestBuffer(webhook.write_messages, batch_size=args.batch_size,
+                                         flush_interval=args.flush_interval_ms / 1000)
+    webhook.ingest_buffer.start()
+    latencies, elapsed = run(args.requests, args.fanout, args.threads)
+    webhook.ingest_buffer.stop()
+    report("buffered", latencies, elapsed)
+
+    expected = (args.requests // args.threads) * args.threads * args.fanout
+    print(f"messages written: {webhook.Message.objects.count()} (expected {expected})")
+    db.drop_database(BENCH_DB)
@@ -0,0 +1,155 @@
+import os
+import re
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Tuple, Mapping
+from configparser import ConfigParser, Error as ConfigError
+
+# bots/<id>.ini compiled once into typed, immutable settings. Workers look a pair
+# up in a dict per message instead of building option names and parsing strings,
+# and mistakes in the file are found when it is loaded rather than halfway
+# through an entry.
+
+OPTION = re.compile(r"^(?P<pair>.+?)_(?:portfolio_percent|leverage_multiple|stop_loss|is_isolated"
+                    r"|tp_\d+_%(?:_of_position)?)$")
+
+
+class BotConfigError(Exception):
+    pass
+
+
+class TakeProfit(NamedTuple):
+    percent: float
+    percent_of_position: float
+
+
+class PairConfig(NamedTuple):
+    pair: str
+    leverage: float
+    is_isolated: bool
+    portfolio_percent: float
+    stop_loss: Optional[float]
+    take_profits: Tuple[TakeProfit, ...]
+
+
+class BotConfig(NamedTuple):
+    bot_id: str
+    max_webhook_message_age_time: int
+    max_order_time: int
+    state_max_age: float
+    # pair (upper case) -> settings, and pair -> why its settings were rejected
+    pairs: Mapping[str, PairConfig]
+    errors: Mapping[str, str]
+
+    def pair(self, pair):
+        # Settings for an entry; a pair missing from the file or rejected on load raises
+        settings = self.pairs.get(pair)
+        if settings is None:
+            raise BotConfigError(self.errors.get(pair, f"no settings for {pair} in bots/{self.bot_id}.ini"))
+        return settings
+
+
+def number(options, pair, name, minimum=0.0, maximum=None):
+    key = f"{pair}_{name}"
+    label = f"{pair.upper()}_{name}"
+    if key not in options:
+        raise BotConfigError(f"{label} is missing")
+    try:
+        value = float(options[key])
+    except ValueError:
+        raise BotConfigError(f"{label} is not a number: {options[key]!r}")
+    if value <= minimum or (maximum is not None and value > maximum):
+        raise BotConfigError(f"{label} is out of range: {options[key]}")
+    return value
+
+
+def compile_pair(options, pair):
+    if f"{pair}_is_isolated" not in options:
+        raise BotConfigError(f"{pair.upper()}_is_isolated is missing")
+    is_isolated = options[f"{pair}_is_isolated"].strip().lower()
+    if is_isolated not in ("true", "false"):
+        raise BotConfigError(f"{pair.upper()}_is_isolated should be true or false")
+    stop_loss = None
+    if f"{pair}_stop_loss" in options:
+        stop_loss = number(options, pair, "stop_loss", maximum=100)
+
+    # Rungs count up from 1; the ladder ends at the first missing tp_<n>_%
+    take_profits = []
+    while f"{pair}_tp_{len(take_profits) + 1}_%" in options:
+        rung = len(take_profits) + 1
+        take_profits.append(TakeProfit(number(options, pair, f"tp_{rung}_%"),
+                                       number(options, pair, f"tp_{rung}_%_of_position", maximum=100)))
+    if take_profits and round(sum(tp.percent_of_position for tp in take_profits), 6) != 100.0:
+        raise BotConfigError(f"{pair.upper()}: sum of take profit percents should be 100.")
+
+    return PairConfig(pair=pair.upper(),
+                      leverage=number(options, pair, "leverage_multiple"),
+                      is_isolated=is_isolated == "true",
+                      portfolio_percent=number(options, pair, "portfolio_percent", maximum=100),
+                      stop_loss=stop_loss,
+                      take_profits=tuple(take_profits))
+
+
+def compile_config(bot_id, config):
+    timing = config['timing'] if config.has_section('timing') else {}
+    try:
+        max_age = int(timing.get('max_webhook_message_age_time', 90))
+        max_order_time = int(timing.get('max_order_time', 60))
+        state_max_age = float(timing.get('state_max_age', 10))
+    except ValueError as e:
+        raise BotConfigError(f"bots/{bot_id}.ini [timing]: {e}")
+
+    # ConfigParser lower-cases option names, so pairs are found in lower case
+    options = dict(config['trade']) if config.has_section('trade') else {}
+    names = set()
+    for option in options:
+        match = OPTION.match(option)
+        if match is None:
+            print(f"bots/{bot_id}.ini: ignoring unknown setting {option}")
+        else:
+            names.add(match.group('pair'))
+
+    pairs = {}
+    errors = {}
+    for name in sorted(names):
+        try:
+            pairs[name.upper()] = compile_pair(options, name)
+        except BotConfigError as e:
+            errors[name.upper()] = f"bots/{bot_id}.ini: {e}"
+    return BotConfig(bot_id=bot_id, max_webhook_message_age_time=max_age, max_order_time=max_order_time,
+                     state_max_age=state_max_age, pairs=MappingProxyType(pairs), errors=MappingProxyType(errors))
+
+
+class BotConfigs:
+    """bot id -> compiled BotConfig, recompiled when bots/<id>.ini changes."""
+
+    def __init__(self, directory='bots'):
+        self.directory = directory
+        self.cache = {}
+
+    def get(self, bot_id):
+        path = os.path.join(self.directory, f"{bot_id}.ini")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        cached = self.cache.get(bot_id)
+        if cached is None or cached[0] != mtime:
+            config = ConfigParser()
+            try:
+                config.read(path)
+                compiled = compile_config(bot_id, config)
+            except ConfigError as e:
+                compiled = BotConfigError(f"bots/{bot_id}.ini can't be parsed: {e}")
+            except BotConfigError as e:
+                compiled = e
+            # A broken file is reported once and then rejected from the cache until it changes
+            if isinstance(compiled, BotConfigError):
+                print(f"Rejected settings: {compiled}")
+            else:
+                for error in compiled.errors.values():
+                    print(f"Rejected settings: {error}")
+            cached = (mtime, compiled)
+            self.cache[bot_id] = cached
+        if isinstance(cached[1], BotConfigError):
+            raise BotConfigError(*cached[1].args)
+        return cached[1]
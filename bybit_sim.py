@@ -0,0 +1,349 @@
+import csv
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the Bybit v2/linear endpoints trade.py and sl-adjuster.py call
+# through ccxt 1.55. Set [main] simulator in master_settings.ini to its url to point
+# every client at it. Accounts are kept per API key in memory, hedge mode only.
+#
+# Deterministic: latency, injected errors and the price walk come from random
+# generators seeded by (seed, endpoint, nth call of that endpoint), so a run with
+# the same requests sees the same responses.
+
+DEFAULT_PRICES = {'BTCUSDT': 40000.0, 'ETHUSDT': 2500.0, 'XRPUSDT': 0.6, 'ADAUSDT': 0.45,
+                  'DOTUSDT': 7.0, 'LTCUSDT': 80.0, 'LINKUSDT': 14.0, 'XTZUSDT': 1.0}
+
+
+class SimError(Exception):
+    def __init__(self, ret_code, ret_msg, http_status=200):
+        super().__init__(ret_msg)
+        self.ret_code = ret_code
+        self.ret_msg = ret_msg
+        self.http_status = http_status
+
+
+class Account:
+    def __init__(self, balance):
+        self.wallet = balance
+        self.positions = {}
+        self.stop_orders = {}
+        self.margin = {}
+        self.next_id = 1
+
+    def sides(self, symbol):
+        if symbol not in self.positions:
+            self.positions[symbol] = {side: {'size': 0.0, 'entry_price': 0.0, 'stop_loss': 0.0}
+                                      for side in ("Buy", "Sell")}
+        return self.positions[symbol]
+
+    def used_margin(self):
+        used = 0.0
+        for symbol, sides in self.positions.items():
+            leverage = self.margin.get(symbol, (10.0, False))[0]
+            used += sum(p['size'] * p['entry_price'] for p in sides.values()) / leverage
+        return used
+
+    def order_id(self):
+        self.next_id += 1
+        return f"sim-{self.next_id:08d}"
+
+
+class Simulator:
+    def __init__(self, seed=1, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, errors=('rate_limit',),
+                 timeout_ms=15000, balance=10000.0, prices=None):
+        self.seed = seed
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.errors = tuple(errors)
+        self.timeout_ms = timeout_ms
+        self.balance = balance
+        self.replay = prices or {}
+        self.prices = {}
+        self.accounts = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def rng(self, endpoint):
+        # One generator per call keeps results independent of how requests interleave
+        with self.lock:
+            n = self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+        return random.Random(f"{self.seed}:{endpoint}:{n}"), n
+
+    def account(self, api_key):
+        with self.lock:
+            if api_key not in self.accounts:
+                self.accounts[api_key] = Account(self.balance)
+            return self.accounts[api_key]
+
+    def price(self, symbol, advance=False):
+        with self.lock:
+            if symbol in self.replay:
+                path = self.replay[symbol]
+                n = self.counts.get(('price', symbol), 0)
+                if advance:
+                    self.counts[('price', symbol)] = n + 1
+                return path[n % len(path)]
+            price = self.prices.get(symbol, DEFAULT_PRICES.get(symbol, 100.0))
+            if advance:
+                n = self.counts[('price', symbol)] = self.counts.get(('price', symbol), 0) + 1
+                step = random.Random(f"{self.seed}:walk:{symbol}:{n}").gauss(0, 0.0005)
+                price = round(price * (1 + step), 6)
+            self.prices[symbol] = price
+            return price
+
+    def handle(self, method, path, params):
+        endpoint = path.strip('/')
+        rng, n = self.rng(endpoint)
+        delay = self.latency_ms + rng.uniform(0, self.jitter_ms)
+        if self.error_rate and rng.random() < self.error_rate:
+            kind = rng.choice(self.errors)
+            if kind == 'timeout':
+                time.sleep(self.timeout_ms / 1000)
+                raise SimError(10000, "server timeout", 504)
+            time.sleep(delay / 1000)
+            if kind == 'server':
+                raise SimError(10000, "service unavailable", 503)
+            raise SimError(10006, "too many visits!")
+        time.sleep(delay / 1000)
+
+        for suffix, func in ROUTES:
+            if endpoint.endswith(suffix):
+                return func(self, params)
+        raise SimError(10001, f"unknown endpoint {endpoint}", 404)
+
+    # Public
+
+    def symbols(self, params):
+        result = []
+        for symbol, price in DEFAULT_PRICES.items():
+            base = symbol[:-4]
+            tick = 0.5 if price > 1000 else (0.05 if price > 10 else 0.0001)
+            result.append({
+                'name': symbol, 'alias': symbol, 'status': "Trading",
+                'base_currency': base, 'quote_currency': "USDT",
+                'price_scale': 2 if price > 10 else 4, 'taker_fee': "0.00075", 'maker_fee': "-0.00025",
+                'leverage_filter': {'min_leverage': 1, 'max_leverage': 100, 'leverage_step': "0.01"},
+                'price_filter': {'min_price': str(tick), 'max_price': "999999", 'tick_size': str(tick)},
+                'lot_size_filter': {'max_trading_qty': 1000000, 'min_trading_qty': 0.001, 'qty_step': 0.001},
+            })
+        return result
+
+    def server_time(self, params):
+        return {}
+
+    def recent_trades(self, params):
+        symbol = params['symbol']
+        price = self.price(symbol, advance=True)
+        return [{'id': "sim", 'symbol': symbol, 'price': price, 'qty': 1, 'side': "Buy",
+                 'time': datetime.utcnow().isoformat() + "Z", 'trade_time_ms': int(time.time() * 1000)}]
+
+    # Private
+
+    def balance_(self, params):
+        account = self.account(params.get('api_key'))
+        used = account.used_margin()
+        return {'USDT': {'equity': account.wallet, 'wallet_balance': account.wallet,
+                         'available_balance': account.wallet - used, 'used_margin': used,
+                         'order_margin': 0, 'position_margin': used, 'realised_pnl': 0, 'unrealised_pnl': 0}}
+
+    def position_list(self, params):
+        account = self.account(params.get('api_key'))
+        symbol = params['symbol']
+        leverage, is_isolated = account.margin.get(symbol, (10.0, False))
+        price = self.price(symbol)
+        rows = []
+        for side, p in account.sides(symbol).items():
+            pnl = (price - p['entry_price']) * p['size'] * (1 if side == "Buy" else -1)
+            rows.append({'user_id': 1, 'symbol': symbol, 'side': side, 'size': p['size'],
+                         'position_value': p['size'] * p['entry_price'], 'entry_price': p['entry_price'],
+                         'liq_price': 0, 'bust_price': 0, 'leverage': leverage, 'is_isolated': is_isolated,
+                         'auto_add_margin': 0, 'position_margin': p['size'] * p['entry_price'] / leverage,
+                         'occ_closing_fee': 0, 'realised_pnl': 0, 'cum_realised_pnl': 0, 'free_qty': p['size'],
+                         'tp_sl_mode': "Full", 'unrealised_pnl': pnl, 'deleverage_indicator': 0,
+                         'risk_id': 1, 'stop_loss': p['stop_loss'], 'take_profit': 0, 'trailing_stop': 0})
+        return rows
+
+    def order_create(self, params):
+        account = self.account(params.get('api_key'))
+        symbol = params['symbol']
+        side = params['side']
+        qty = float(params['qty'])
+        if qty <= 0:
+            raise SimError(10001, "qty must be greater than zero")
+        price = self.price(symbol)
+        sides = account.sides(symbol)
+        reduce_only = str(params.get('reduce_only')).lower() == 'true'
+        with self.lock:
+            if reduce_only:
+                # In hedge mode a reducing Buy closes the short side and vice versa
+                p = sides["Sell" if side == "Buy" else "Buy"]
+                if p['size'] <= 0:
+                    raise SimError(30063, "reduce-only rule not satisfied")
+                closed = min(qty, p['size'])
+                direction = 1 if side == "Sell" else -1
+                account.wallet += (price - p['entry_price']) * closed * direction
+                p['size'] = round(p['size'] - closed, 8)
+                if p['size'] == 0:
+                    p['entry_price'] = 0.0
+                    p['stop_loss'] = 0.0
+            else:
+                if qty * price / account.margin.get(symbol, (10.0, False))[0] > account.wallet - account.used_margin():
+                    raise SimError(30031, "insufficient available balance")
+                p = sides[side]
+                p['entry_price'] = (p['entry_price'] * p['size'] + price * qty) / (p['size'] + qty)
+                p['size'] = round(p['size'] + qty, 8)
+                if params.get('stop_loss'):
+                    p['stop_loss'] = float(params['stop_loss'])
+        return {'order_id': account.order_id(), 'user_id': 1, 'symbol': symbol, 'side': side,
+                'order_type': params.get('order_type', "Market"), 'price': price, 'qty': qty,
+                'time_in_force': params.get('time_in_force', "GoodTillCancel"), 'order_status': "Created",
+                'last_exec_price': 0, 'cum_exec_qty': 0, 'cum_exec_value': 0, 'cum_exec_fee': 0,
+                'reduce_only': reduce_only, 'close_on_trigger': False, 'order_link_id': "",
+                'created_time': datetime.utcnow().isoformat() + "Z", 'updated_time': datetime.utcnow().isoformat() + "Z"}
+
+    def stop_order_create(self, params):
+        account = self.account(params.get('api_key'))
+        stop_order_id = account.order_id()
+        with self.lock:
+            account.stop_orders.setdefault(params['symbol'], {})[stop_order_id] = dict(params)
+        return {'stop_order_id': stop_order_id, 'symbol': params['symbol'], 'side': params.get('side'),
+                'order_status': "Untriggered"}
+
+    def stop_order_cancel_all(self, params):
+        account = self.account(params.get('api_key'))
+        with self.lock:
+            cancelled = account.stop_orders.pop(params['symbol'], {})
+        return list(cancelled)
+
+    def set_leverage(self, params):
+        account = self.account(params.get('api_key'))
+        symbol = params['symbol']
+        leverage = float(params['buy_leverage'])
+        current, is_isolated = account.margin.get(symbol, (10.0, False))
+        if current == leverage:
+            raise SimError(34036, "leverage not modified")
+        account.margin[symbol] = (leverage, is_isolated)
+        return leverage
+
+    def switch_isolated(self, params):
+        account = self.account(params.get('api_key'))
+        symbol = params['symbol']
+        is_isolated = str(params['is_isolated']).lower() == 'true'
+        current, current_isolated = account.margin.get(symbol, (10.0, False))
+        if current_isolated == is_isolated:
+            raise SimError(130056, "Isolated not modified")
+        account.margin[symbol] = (float(params.get('buy_leverage', current)), is_isolated)
+        return None
+
+    def trading_stop(self, params):
+        account = self.account(params.get('api_key'))
+        p = account.sides(params['symbol'])[params['side']]
+        if p['size'] <= 0:
+            raise SimError(130025, "position size is zero")
+        p['stop_loss'] = float(params['stop_loss'])
+        return None
+
+
+ROUTES = [
+    ('public/symbols', Simulator.symbols),
+    ('public/time', Simulator.server_time),
+    ('recent-trading-records', Simulator.recent_trades),
+    ('wallet/balance', Simulator.balance_),
+    ('linear/position/list', Simulator.position_list),
+    ('linear/order/create', Simulator.order_create),
+    ('linear/stop-order/create', Simulator.stop_order_create),
+    ('linear/stop-order/cancel-all', Simulator.stop_order_cancel_all),
+    ('linear/position/set-leverage', Simulator.set_leverage),
+    ('linear/position/switch-isolated', Simulator.switch_isolated),
+    ('linear/position/trading-stop', Simulator.trading_stop),
+]
+
+
+class Handler(BaseHTTPRequestHandler):
+    simulator = None
+
+    def respond(self, method):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode()
+            try:
+                params.update(json.loads(body))
+            except ValueError:
+                params.update(parse_qsl(body))
+        status = 200
+        try:
+            payload = {'ret_code': 0, 'ret_msg': "OK", 'ext_code': "", 'ext_info': "",
+                       'result': self.simulator.handle(method, url.path, params)}
+        except SimError as e:
+            status = e.http_status
+            payload = {'ret_code': e.ret_code, 'ret_msg': e.ret_msg, 'ext_code': "", 'ext_info': "", 'result': None}
+        except (KeyError, ValueError) as e:
+            payload = {'ret_code': 10001, 'ret_msg': f"params error: {e}", 'ext_code': "", 'ext_info': "",
+                       'result': None}
+        payload['time_now'] = f"{time.time():.6f}"
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_prices(path):
+    # CSV with symbol,price rows; each symbol replays its rows in order and wraps around
+    prices = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            prices.setdefault(row['symbol'].replace('/', ''), []).append(float(row['price']))
+    return prices
+
+
+def start(simulator, host='127.0.0.1', port=0):
+    # Serve in a background thread of this process; returns the server and its url
+    handler = type('SimHandler', (Handler,), {'simulator': simulator})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bybit-sim", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local Bybit linear API simulator.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help="share of requests that fail")
+    parser.add_argument('--errors', default='rate_limit', help="comma separated: rate_limit, server, timeout")
+    parser.add_argument('--balance', type=float, default=10000)
+    parser.add_argument('--prices', help="CSV of symbol,price rows to replay")
+    args = parser.parse_args()
+
+    sim = Simulator(seed=args.seed, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                    error_rate=args.error_rate, errors=args.errors.split(","), balance=args.balance,
+                    prices=load_prices(args.prices) if args.prices else None)
+    server, url = start(sim, args.host, args.port)
+    print(f"Bybit simulator on {url} (seed {args.seed}) ... press Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,108 @@
+import json
+import time
+import threading
+import contextvars
+from datetime import datetime
+from urllib.parse import urlsplit
+
+# Every REST request a ccxt client makes goes through its fetch() method. CallTimer
+# wraps that method on one client and keeps a span per request: endpoint, proxy,
+# duration, outcome and which attempt of a retried call it was.
+
+local = threading.local()
+spans_lock = threading.Lock()
+# Spans of the message handled in the current context; pairs of one bot can run side by side
+current = contextvars.ContextVar('current_spans', default=None)
+
+
+def current_attempt():
+    # Set by the retry policy around each attempt, 0 for a first try
+    return getattr(local, 'attempt', 0)
+
+
+def set_attempt(attempt):
+    local.attempt = attempt
+
+
+class CallTimer:
+    def __init__(self, exchange, spans_path=None):
+        self.exchange = exchange
+        self.spans_path = spans_path
+        self.lock = threading.Lock()
+        self.fetch = exchange.fetch
+        exchange.fetch = self.timed_fetch
+        exchange.call_timer = self
+
+    def proxy(self):
+        proxies = getattr(self.exchange, 'proxies', None)
+        if isinstance(proxies, dict) and proxies:
+            return proxies.get('https') or proxies.get('http')
+        return getattr(self.exchange, 'https_proxy', None) or None
+
+    def timed_fetch(self, url, method='GET', headers=None, body=None):
+        span = {
+            'at': datetime.utcnow(),
+            'method': method,
+            'endpoint': urlsplit(url).path,
+            'proxy': self.proxy(),
+            'attempt': current_attempt(),
+        }
+        start = time.perf_counter()
+        try:
+            response = self.fetch(url, method, headers, body)
+            span['status'] = "ok"
+            return response
+        except Exception as e:
+            span['status'] = "error"
+            span['error'] = type(e).__name__
+            raise
+        finally:
+            span['ms'] = round((time.perf_counter() - start) * 1000, 1)
+            collector = current.get()
+            if collector is not None:
+                with self.lock:
+                    collector['spans'].append(span)
+
+    def begin(self, **context):
+        # Spans from here on in this context belong to this message
+        current.set({'spans': [], 'context': context})
+
+    def end(self):
+        # Compact per-endpoint summary of the current spans; raw spans go to the file if enabled
+        collector = current.get() or {'spans': [], 'context': {}}
+        current.set(None)
+        with self.lock:
+            spans = list(collector['spans'])
+        context = collector['context']
+        if self.spans_path and spans:
+            self.write_spans(spans, context)
+        endpoints = {}
+        for span in spans:
+            e = endpoints.setdefault(span['endpoint'], {'n': 0, 'ms': 0.0, 'max_ms': 0.0, 'errors': 0, 'retries': 0})
+            e['n'] += 1
+            e['ms'] = round(e['ms'] + span['ms'], 1)
+            e['max_ms'] = max(e['max_ms'], span['ms'])
+            e['errors'] += span['status'] != "ok"
+            e['retries'] += span['attempt'] > 0
+        return {
+            'calls': len(spans),
+            'ms': round(sum(span['ms'] for span in spans), 1),
+            'retries': sum(e['retries'] for e in endpoints.values()),
+            'errors': sum(e['errors'] for e in endpoints.values()),
+            'proxy': self.proxy(),
+            # Mongo keys can't hold dots
+            'endpoints': {path.replace('.', '_'): e for path, e in endpoints.items()},
+        }
+
+    def write_spans(self, spans, context):
+        lines = []
+        for span in spans:
+            record = dict(context, **span)
+            record['at'] = span['at'].isoformat()
+            lines.append(json.dumps(record, default=str) + "\n")
+        try:
+            # One append per message keeps lines from several trade processes whole
+            with spans_lock, open(self.spans_path, 'a', encoding='utf-8') as f:
+                f.write("".join(lines))
+        except OSError as e:
+            print(f"Could not write call spans: {e}")
@@ -0,0 +1,42 @@
+class CoalesceRules:
+    """Superseding rules read from the [coalesce] settings section.
+
+    Each option is a command followed by the earlier commands it supersedes, e.g.
+    ``exit-long: enter-long, take-profit-long-1``. A pending message is cancelled
+    when a later pending message for the same pair supersedes it and no other
+    command for that pair sits between them.
+    """
+
+    def __init__(self, config):
+        self.enabled = False
+        self.supersedes = {}
+        if 'coalesce' in config.sections():
+            section = config['coalesce']
+            self.enabled = section.getboolean('enabled', fallback=True)
+            for command, earlier in section.items():
+                if command == 'enabled':
+                    continue
+                self.supersedes[command.lower()] = {c.strip().lower() for c in earlier.split(",") if c.strip()}
+
+    def plan(self, messages):
+        # Returns the messages to run, in order, and (cancelled, superseded_by) pairs
+        if not self.enabled or not self.supersedes:
+            return list(messages), []
+        kept = []
+        cancelled = []
+        for msg in messages:
+            superseded = self.supersedes.get(msg.command.lower())
+            if superseded:
+                # Walk back over this pair's latest commands; the first one not superseded
+                # stops the walk, since dropping anything before it would change the outcome
+                cancelled_here = []
+                for earlier in reversed(kept):
+                    if earlier.pair.upper() != msg.pair.upper():
+                        continue
+                    if earlier.command.lower() not in superseded:
+                        break
+                    cancelled_here.append(earlier)
+                cancelled.extend((earlier, msg) for earlier in reversed(cancelled_here))
+                kept = [earlier for earlier in kept if not any(earlier is c for c in cancelled_here)]
+            kept.append(msg)
+        return kept, cancelled
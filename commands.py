@@ -0,0 +1,6 @@
+# Command names an alert may carry. trade.py registers a handler for each; the
+# webhook rejects anything else before it is queued.
+DIRECTIONS = ("long", "short")
+
+NAMES = frozenset([f"{action}-{direction}" for action in ("enter", "exit") for direction in DIRECTIONS] +
+                  [f"take-profit-{direction}-{rung}" for direction in DIRECTIONS for rung in (1, 2, 3)])
@@ -0,0 +1,46 @@
+import os
+import csv
+import pickle
+
+
+class CsvIndex:
+    """Rows of a small CSV keyed by one column, with a pickle sidecar.
+
+    The sidecar is rebuilt whenever the CSV's mtime or size changes, so a
+    freshly started trade.py loads one pickle instead of parsing the CSV.
+    """
+
+    def __init__(self, path, key='botid'):
+        self.path = path
+        self.key = key
+        self.sidecar = f"{path}.idx"
+        self.rows = None
+
+    def load(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return {}
+        signature = (stat.st_mtime_ns, stat.st_size)
+        try:
+            with open(self.sidecar, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['signature'] == signature:
+                return cached['rows']
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+            pass
+        with open(self.path, newline='') as f:
+            rows = {row[self.key].strip(): row for row in csv.DictReader(f) if row.get(self.key)}
+        try:
+            tmp = f"{self.sidecar}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                pickle.dump({'signature': signature, 'rows': rows}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.sidecar)
+        except OSError:
+            pass
+        return rows
+
+    def get(self, key):
+        if self.rows is None:
+            self.rows = self.load()
+        return self.rows.get(str(key).strip())
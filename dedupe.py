@@ -0,0 +1,43 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache:
+    """Thread safe set of recently seen keys, each forgotten ttl seconds after it was added."""
+
+    def __init__(self, ttl, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def _evict(self, now):
+        # Entries are kept in insertion order and share one ttl, so the oldest expire first
+        while self.entries:
+            key, expires_at = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) < self.max_size:
+                break
+            self.entries.popitem(last=False)
+
+    def add(self, key):
+        # Returns True when the key was not seen within the ttl
+        now = time.monotonic()
+        with self.lock:
+            self._evict(now)
+            if key in self.entries:
+                return False
+            self.entries[key] = now + self.ttl
+            return True
+
+    def discard(self, key):
+        # Forget a key whose message was never stored, so a re-send goes through
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def time_bucket(window):
+    return int(time.time() // window)
@@ -0,0 +1,58 @@
+import sys
+import types
+import importlib.util
+
+# ccxt/__init__.py imports every exchange ccxt ships, roughly twice the import
+# time of the bybit module and its base classes. load_bybit() registers an empty
+# ccxt package so only ccxt.bybit and what it needs get imported. The rest of
+# the package is imported on first access to anything else on it.
+
+
+def install_light_package():
+    spec = importlib.util.find_spec('ccxt')
+    package = types.ModuleType('ccxt')
+    package.__spec__ = spec
+    package.__file__ = spec.origin
+    package.__path__ = list(spec.submodule_search_locations)
+    package.__package__ = 'ccxt'
+    loading = []
+
+    def complete(name):
+        # Someone wants more than bybit: run the real package __init__ in place
+        if loading or name.startswith('__'):
+            raise AttributeError(name)
+        loading.append(name)
+        try:
+            del package.__getattr__
+            spec.loader.exec_module(package)
+        finally:
+            loading.pop()
+        return getattr(package, name)
+
+    package.__getattr__ = complete
+    sys.modules['ccxt'] = package
+
+
+def load_bybit():
+    if 'ccxt' not in sys.modules:
+        try:
+            install_light_package()
+        except Exception:
+            sys.modules.pop('ccxt', None)
+    from ccxt.bybit import bybit
+    # Like the real package, ccxt.bybit is the class rather than the submodule
+    sys.modules['ccxt'].bybit = bybit
+    return bybit
+
+
+def point_at_simulator(exchange, url):
+    # Send every request of this client to a local bybit_sim.py instead of Bybit
+    def rewrite(urls):
+        if isinstance(urls, dict):
+            return {name: rewrite(value) for name, value in urls.items()}
+        return url.rstrip('/')
+
+    exchange.urls['api'] = rewrite(exchange.urls['api'])
+    exchange.proxies = None
+    exchange.simulator_url = url
+    return exchange
@@ -0,0 +1,73 @@
+import time
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+
+
+class IngestBuffer:
+    """Bounded in-process buffer that a background thread flushes in micro-batches.
+
+    Every item put in the buffer is the list of records produced by one request,
+    so a fan-out is never split across two flushes.
+    """
+
+    def __init__(self, flush_func, max_size=10000, batch_size=200, flush_interval=0.02, max_attempts=5):
+        self.flush_func = flush_func
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue(maxsize=max_size)
+        self.stop_event = Event()
+        self.writer = Thread(target=self._run, name="ingest-writer", daemon=True)
+
+    def start(self):
+        self.writer.start()
+
+    def put(self, records):
+        # Returns False when the buffer is full so the caller can write synchronously
+        try:
+            self.queue.put_nowait(records)
+            return True
+        except Full:
+            return False
+
+    def stop(self):
+        self.stop_event.set()
+        self.writer.join()
+
+    def _collect(self):
+        # Wait for the first item, then keep filling until batch size or deadline
+        try:
+            batch = list(self.queue.get(timeout=0.5))
+        except Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.extend(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        # Records carry their ids, so retrying a partly written batch doesn't duplicate anything
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.flush_func(batch)
+                return
+            except Exception as e:
+                print(f"ERROR: flushing {len(batch)} messages failed (attempt {attempt}/{self.max_attempts}): {e}")
+                if self.stop_event.is_set():
+                    print(f"ERROR: dropping {len(batch)} messages on shutdown.")
+                    return
+                if attempt < self.max_attempts:
+                    time.sleep(1)
+        print(f"ERROR: dropping {len(batch)} messages after {self.max_attempts} failed attempts.")
+
+    def _run(self):
+        while not (self.stop_event.is_set() and self.queue.empty()):
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
@@ -0,0 +1,95 @@
+import argparse
+from datetime import datetime, timedelta
+from mongoengine import connect
+from mongoengine.connection import get_db
+
+# Per-stage latency of finished messages, from the timestamps stamped along the way:
+#   queue     webhook accepted -> dispatcher launched the bot
+#   spawn     dispatcher launched -> trade worker started on the bot
+#   worker    worker started -> first exchange call for this message (includes earlier messages of the batch)
+#   exchange  first exchange call -> order acknowledged
+#   finish    order acknowledged -> status written
+#   total     webhook accepted -> status written
+STAGES = [
+    ('queue', 'timestamp', 'dispatched_at'),
+    ('spawn', 'dispatched_at', 'worker_started_at'),
+    ('worker', 'worker_started_at', 'exchange_first_call_at'),
+    ('exchange', 'exchange_first_call_at', 'order_ack_at'),
+    ('finish', 'order_ack_at', 'finished_at'),
+    ('total', 'timestamp', 'finished_at'),
+]
+PERCENTILES = [50, 90, 99]
+
+
+def percentile_expr(p):
+    # Nearest-rank on the sorted list pushed by $group
+    return {'$arrayElemAt': ['$values', {'$toInt': {'$floor': {'$multiply': [p / 100, {'$subtract': ['$n', 1]}]}}}]}
+
+
+def lag_pipeline(since, until, by, bot_id=None, archive=False):
+    match = {'finished_at': {'$gte': since, '$lt': until}}
+    if bot_id is not None:
+        match['bot_id'] = bot_id
+    pipeline = [{'$match': match}]
+    if archive:
+        # Messages archived inside the window still count
+        pipeline.append({'$unionWith': {'coll': 'message_archive', 'pipeline': [{'$match': match}]}})
+    pipeline += [
+        {'$project': {
+            **{field: 1 for field in by},
+            'stages': [{'stage': name, 'ms': {'$subtract': [f'${end}', f'${start}']}}
+                       for name, start, end in STAGES],
+        }},
+        {'$unwind': '$stages'},
+        {'$match': {'stages.ms': {'$ne': None}}},
+        {'$sort': {'stages.ms': 1}},
+        {'$group': {
+            '_id': {**{field: f'${field}' for field in by}, 'stage': '$stages.stage'},
+            'values': {'$push': '$stages.ms'},
+            'n': {'$sum': 1},
+        }},
+        {'$project': {
+            '_id': 1,
+            'n': 1,
+            **{f'p{p}': percentile_expr(p) for p in PERCENTILES},
+            'max': {'$arrayElemAt': ['$values', -1]},
+        }},
+    ]
+    return pipeline
+
+
+def lag_report(since, until, by, bot_id=None, archive=False):
+    rows = list(get_db()['message'].aggregate(lag_pipeline(since, until, by, bot_id, archive), allowDiskUse=True))
+    order = [name for name, _, _ in STAGES]
+    rows.sort(key=lambda r: ([str(r['_id'].get(field)) for field in by], order.index(r['_id']['stage'])))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency percentiles per message stage.")
+    parser.add_argument('--since', type=datetime.fromisoformat,
+                        help="start of the window (UTC), default 24 hours ago")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="end of the window (UTC), default now")
+    parser.add_argument('--by', default='bot_id,pair,command',
+                        help="comma separated grouping fields, empty for one overall group")
+    parser.add_argument('--bot')
+    parser.add_argument('--archive', action='store_true', help="include archived messages")
+    args = parser.parse_args()
+
+    until = args.until or datetime.utcnow()
+    since = args.since or until - timedelta(hours=24)
+    by = [field for field in args.by.split(',') if field]
+
+    connect('trade_db')
+    rows = lag_report(since, until, by, args.bot, args.archive)
+    if not rows:
+        print("No finished messages with timing data in this window.")
+        raise SystemExit(0)
+    print(f"{'group':<40} {'stage':<9} {'n':>6} " + " ".join(f"{'p' + str(p):>9}" for p in PERCENTILES)
+          + f" {'max':>9}   (ms)")
+    last_group = None
+    for row in rows:
+        group = " ".join(str(row['_id'].get(field)) for field in by) or "all"
+        print(f"{group if group != last_group else '':<40} {row['_id']['stage']:<9} {row['n']:>6} "
+              + " ".join(f"{row[f'p{p}']:>9}" for p in PERCENTILES) + f" {row['max']:>9}")
+        last_group = group
@@ -0,0 +1,93 @@
+import os
+import socket
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from uuid import uuid4
+from configparser import ConfigParser
+from mongoengine import *
+from pymongo.errors import DuplicateKeyError
+
+# Read lock settings
+lock_config = ConfigParser()
+lock_config.read("queue_settings.ini")
+
+lease_seconds = lock_config.getint('locks', 'lease_seconds', fallback=60)
+max_hold_seconds = lock_config.getint('locks', 'max_hold_seconds', fallback=1800)
+
+
+# MongoEngine Schema
+class Lock(Document):
+    bot_id = StringField(required=True, unique=True)
+    owner = StringField()
+    expires_at = DateTimeField()
+
+
+def new_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+def ensure_lock_index():
+    # Locks left by older versions have no lease; drop them with the expired ones
+    now = datetime.utcnow()
+    Lock._get_collection().delete_many({'$or': [{'expires_at': {'$lt': now}}, {'expires_at': None}]})
+    Lock.ensure_indexes()
+
+
+def acquire_lock(bot_id, owner, lease=lease_seconds):
+    # Take a free or expired lock in one round trip. The unique index on bot_id turns
+    # the upsert into a duplicate key error while somebody else holds a live lease.
+    now = datetime.utcnow()
+    try:
+        Lock._get_collection().find_one_and_update(
+            {'bot_id': bot_id, '$or': [{'expires_at': {'$lt': now}}, {'expires_at': None}]},
+            {'$set': {'owner': owner, 'expires_at': now + timedelta(seconds=lease)}},
+            upsert=True)
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def renew_lock(bot_id, owner, lease=lease_seconds):
+    result = Lock._get_collection().update_one(
+        {'bot_id': bot_id, 'owner': owner},
+        {'$set': {'expires_at': datetime.utcnow() + timedelta(seconds=lease)}})
+    return result.matched_count == 1
+
+
+def release_lock(bot_id, owner=None):
+    query = {'bot_id': bot_id}
+    if owner is not None:
+        query['owner'] = owner
+    return Lock._get_collection().delete_one(query).deleted_count == 1
+
+
+class LockHeartbeat:
+    """Extends a lock lease in the background while a bot is running."""
+
+    def __init__(self, bot_id, owner, lease=lease_seconds, max_hold=max_hold_seconds):
+        self.bot_id = bot_id
+        self.owner = owner
+        self.lease = lease
+        self.max_hold = max_hold
+        self.stop_event = Event()
+        self.thread = Thread(target=self._run, name=f"lock-heartbeat-{bot_id}", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        deadline = datetime.utcnow() + timedelta(seconds=self.max_hold)
+        while not self.stop_event.wait(self.lease / 3):
+            if datetime.utcnow() >= deadline:
+                print(f"Lock for bot {self.bot_id} held longer than {self.max_hold}s, letting the lease expire.")
+                return
+            try:
+                if not renew_lock(self.bot_id, self.owner, self.lease):
+                    print(f"Lock for bot {self.bot_id} was lost.")
+                    return
+            except Exception as e:
+                print(f"Lock heartbeat error: {e}")
@@ -0,0 +1,28 @@
+from datetime import datetime
+from mongoengine import *
+
+
+# MongoEngine Schema
+class MarginState(Document):
+    # Last leverage and margin mode confirmed on the exchange for a bot's symbol
+    bot_id = StringField(required=True, unique_with='symbol')
+    symbol = StringField(required=True)
+    leverage = FloatField()
+    is_isolated = BooleanField()
+    updated_at = DateTimeField(default=datetime.utcnow)
+
+
+def get_margin(bot_id, symbol):
+    state = MarginState.objects(bot_id=bot_id, symbol=symbol).first()
+    if state is None:
+        return None
+    return state.leverage, state.is_isolated
+
+
+def save_margin(bot_id, symbol, leverage, is_isolated):
+    MarginState.objects(bot_id=bot_id, symbol=symbol).update_one(
+        set__leverage=leverage, set__is_isolated=is_isolated, set__updated_at=datetime.utcnow(), upsert=True)
+
+
+def forget_margin(bot_id, symbol):
+    MarginState.objects(bot_id=bot_id, symbol=symbol).delete()
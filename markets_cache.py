@@ -0,0 +1,151 @@
+import os
+import time
+import pickle
+import threading
+from configparser import ConfigParser
+from exchange_loader import point_at_simulator
+
+# Markets metadata shared on local disk by every ccxt client of this machine.
+# One pickle per exchange and network; a fresh snapshot pre-populates a client
+# with set_markets() so it never calls load_markets() over the network.
+
+cache_config = ConfigParser()
+cache_config.read("master_settings.ini")
+
+enabled = cache_config.getboolean('markets_cache', 'enabled', fallback=True)
+cache_dir = cache_config.get('markets_cache', 'dir', fallback='cache')
+ttl = cache_config.getfloat('markets_cache', 'ttl_seconds', fallback=3600)
+max_stale = cache_config.getfloat('markets_cache', 'max_stale_seconds', fallback=24 * 3600)
+simulator = cache_config.get('main', 'simulator', fallback='')
+
+lock = threading.Lock()
+refreshing = set()
+memory = {}
+
+
+def is_testnet(exchange):
+    # set_sandbox_mode swaps in the test urls and keeps the originals under apiBackup
+    return 'apiBackup' in exchange.urls
+
+
+def cache_key(exchange):
+    if getattr(exchange, 'simulator_url', None):
+        return f"{exchange.id}-simulator"
+    return f"{exchange.id}-{'testnet' if is_testnet(exchange) else 'mainnet'}"
+
+
+def cache_path(key):
+    return os.path.join(cache_dir, f"markets-{key}.pickle")
+
+
+def read_snapshot(key):
+    # Snapshots already read by this process are reused until the file changes
+    path = cache_path(key)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = memory.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        print(f"Ignoring unreadable markets cache {path}: {e}")
+        return None
+    memory[key] = (mtime, snapshot)
+    return snapshot
+
+
+def write_snapshot(key, exchange):
+    snapshot = {
+        'markets': list(exchange.markets.values()),
+        'currencies': exchange.currencies,
+        'fetched_at': time.time(),
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(key)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # Readers in other processes see either the old or the new file, never half of one
+    os.replace(tmp, path)
+    return snapshot
+
+
+def fetch_public(exchange_class, testnet, proxies=None):
+    client = exchange_class({'enableRateLimit': True})
+    if proxies:
+        client.proxies = proxies
+    if testnet:
+        client.set_sandbox_mode(True)
+    if simulator:
+        point_at_simulator(client, simulator)
+    client.load_markets()
+    return client
+
+
+def refresh(exchange_class, testnet, proxies=None):
+    client = fetch_public(exchange_class, testnet, proxies)
+    return write_snapshot(cache_key(client), client)
+
+
+def refresh_in_background(exchange):
+    key = cache_key(exchange)
+    with lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+
+    def run():
+        try:
+            refresh(type(exchange), is_testnet(exchange), exchange.proxies)
+        except Exception as e:
+            print(f"Markets cache refresh failed for {key}: {e}")
+        finally:
+            with lock:
+                refreshing.discard(key)
+
+    threading.Thread(target=run, name=f"markets-refresh-{key}", daemon=True).start()
+
+
+def load_markets(exchange, reload=False):
+    """Drop-in for exchange.load_markets() that goes through the disk cache.
+
+    A fresh snapshot is used as is, a stale one is used while a background thread
+    refreshes it, and a missing or too old one is loaded from the exchange.
+    """
+    if exchange.markets and not reload:
+        return exchange.markets
+    if not enabled:
+        return exchange.load_markets(reload)
+    key = cache_key(exchange)
+    snapshot = None if reload else read_snapshot(key)
+    age = time.time() - snapshot['fetched_at'] if snapshot is not None else None
+    if snapshot is None or age > max_stale:
+        markets = exchange.load_markets(True)
+        try:
+            write_snapshot(key, exchange)
+        except OSError as e:
+            print(f"Could not write markets cache: {e}")
+        return markets
+    exchange.set_markets(snapshot['markets'], snapshot['currencies'])
+    if exchange.options.get('adjustForTimeDifference'):
+        # fetch_markets() is where ccxt syncs the clock; without it requests are signed with our own time
+        exchange.load_time_difference()
+    if age > ttl:
+        refresh_in_background(exchange)
+    return exchange.markets
+
+
+def keep_fresh(exchange_class, testnet, stop_event, interval=None):
+    # Long-running services call this in a thread so workers always find a fresh snapshot
+    if interval is None:
+        interval = max(ttl / 2, 60)
+    while not stop_event.is_set():
+        try:
+            refresh(exchange_class, testnet)
+        except Exception as e:
+            print(f"Markets cache refresh failed: {e}")
+        stop_event.wait(interval)
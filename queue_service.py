@@ -1,7 +1,16 @@
-from datetime import datetime
-from threading import Event
+from datetime import datetime, timedelta
+from threading import Event, Thread
+from configparser import ConfigParser
 from mongoengine import *
+from pymongo import CursorType, UpdateMany
 import subprocess
+from collections import Counter
+from worker_pool import WorkerPool
+from scheduler import PriorityClasses, BotKeys
+from bot_config import BotConfigs, BotConfigError
+import retention
+import markets_cache
+from locks import Lock, new_owner, acquire_lock, release_lock, ensure_lock_index
 
 
 # MongoEngine Schema
@@ -13,49 +22,238 @@ class Message(Document):
     timestamp = DateTimeField(default=datetime.utcnow)
     status = StringField(default="pending")
     error_msg = StringField()
+    error_severity = StringField()
+    group_id = StringField()
+    dedupe_key = StringField()
+    dispatched_at = DateTimeField()
+    worker_started_at = DateTimeField()
+    exchange_first_call_at = DateTimeField()
+    order_ack_at = DateTimeField()
+    finished_at = DateTimeField()
+    timings = DictField()
+    tp_orders = ListField(DictField())
+    call_summary = DictField()
 
+    meta = {
+        'indexes': [('status', 'bot_id', 'timestamp')],
+        'auto_create_index': False,
+    }
+
+
+class Signal(Document):
+    # Capped collection tailed by the queue service to wake up on new work
+    bot_ids = ListField(StringField())
+    timestamp = DateTimeField(default=datetime.utcnow)
+    meta = {'max_documents': 10000, 'max_size': 4 * 1024 * 1024}
 
-class Lock(Document):
-    bot_id = StringField(required=True)
 
+# Read queue settings
+queue_config = ConfigParser()
+queue_config.read("queue_settings.ini")
+
+dispatch_mode = queue_config.get('dispatch', 'mode', fallback='poll')
+sweep_interval = queue_config.getfloat('dispatch', 'sweep_interval', fallback=2)
+worker_mode = queue_config.get('workers', 'mode', fallback='subprocess')
+max_concurrent = queue_config.getint('scheduler', 'max_concurrent', fallback=0)
+max_per_key = queue_config.getint('scheduler', 'max_per_key', fallback=0)
+priority_classes = PriorityClasses(queue_config)
+bot_keys = BotKeys()
+bot_configs = BotConfigs()
+
+pool = None
 
 exit_event = Event()
+wake_event = Event()
+
+
+def tail_signals():
+    # Block on a tailable cursor over the capped signal collection and wake the dispatcher on every insert
+    collection = Signal._get_collection()
+    if collection.estimated_document_count() == 0:
+        # A tailable cursor on an empty capped collection dies immediately
+        Signal(bot_ids=[]).save()
+    last_id = collection.find().sort('$natural', -1).limit(1).next()['_id']
+    while not exit_event.is_set():
+        try:
+            cursor = collection.find({'_id': {'$gt': last_id}}, cursor_type=CursorType.TAILABLE_AWAIT)
+            cursor.max_await_time_ms(1000)
+            while cursor.alive and not exit_event.is_set():
+                for doc in cursor:
+                    last_id = doc['_id']
+                    wake_event.set()
+        except Exception as e:
+            print(f"Signal cursor error: {e}")
+        exit_event.wait(1)
+
+
+def pending_work():
+    # Pending bots with per-command counts, oldest timestamp and lock state in one round trip
+    now = datetime.utcnow()
+    work = list(Message._get_collection().aggregate([
+        {'$match': {'status': "pending"}},
+        {'$group': {'_id': {'bot_id': '$bot_id', 'command': '$command'},
+                    'count': {'$sum': 1}, 'oldest': {'$min': '$timestamp'}, 'newest': {'$max': '$timestamp'}}},
+        {'$group': {'_id': '$_id.bot_id', 'count': {'$sum': '$count'}, 'oldest': {'$min': '$oldest'},
+                    'newest': {'$max': '$newest'},
+                    'commands': {'$push': {'command': '$_id.command', 'count': '$count'}}}},
+        {'$lookup': {'from': Lock._get_collection_name(), 'localField': '_id', 'foreignField': 'bot_id',
+                     'as': 'lock'}},
+    ]))
+    for w in work:
+        w['locked'] = any(lock.get('expires_at') is None or lock['expires_at'] > now for lock in w.pop('lock'))
+        w['rank'] = priority_classes.bot_rank(w)
+    # Most urgent class first, oldest first inside a class
+    work.sort(key=lambda w: (w['rank'], w['oldest']))
+    return work
+
+
+def expire_stale(work):
+    # Fail expired pending messages in one bulk write, grouped by each bot's max age,
+    # and drop bots that have nothing left so no worker is started just to discard them
+    now = datetime.utcnow()
+    by_age = {}
+    live = []
+    for w in work:
+        try:
+            max_age = bot_configs.get(w['_id']).max_webhook_message_age_time
+        except BotConfigError:
+            # Left to the worker, which fails the bot's messages with the config error
+            live.append(w)
+            continue
+        cutoff = now - timedelta(seconds=max_age)
+        if w['oldest'] <= cutoff:
+            by_age.setdefault(max_age, []).append(w['_id'])
+        if w['newest'] > cutoff:
+            live.append(w)
+    if by_age:
+        result = Message._get_collection().bulk_write([
+            UpdateMany({'status': "pending", 'bot_id': {'$in': bot_ids},
+                        'timestamp': {'$lte': now - timedelta(seconds=max_age)}},
+                       {'$set': {'status': "failed", 'error_severity': "warn", 'finished_at': now,
+                                 'error_msg': f"max_webhook_message_age_time expired for message. ({max_age}s)"}})
+            for max_age, bot_ids in by_age.items()
+        ], ordered=False)
+        print(f"Expired {result.modified_count} stale messages.")
+    return live
+
+
+def running_bots():
+    now = datetime.utcnow()
+    return {lock['bot_id'] for lock in Lock._get_collection().find(
+        {'$or': [{'expires_at': {'$gt': now}}, {'expires_at': None}]}, {'bot_id': 1})}
 
 
-def launch_bot(bot_id):
+def retention_loop():
+    # Keep the hot message collection small without delaying dispatch
+    interval = queue_config.getfloat('retention', 'interval_minutes', fallback=10) * 60
+    retention.ensure_archive_indexes()
+    while not exit_event.is_set():
+        try:
+            moved = retention.archive_messages()
+            if moved:
+                print(f"Archived {moved} finished messages.")
+        except Exception as e:
+            print(f"Retention error: {e}")
+        exit_event.wait(interval)
+
+
+def markets_refresh_loop():
+    # Keep the shared markets snapshot fresh so trade workers never load markets over the network
+    import ccxt
+    testnet = markets_cache.cache_config.get('main', 'testnet', fallback='false') == 'true'
+    markets_cache.keep_fresh(ccxt.bybit, testnet, exit_event)
+
+
+def release_crashed_bot(bot_id, owner):
+    release_lock(bot_id, owner)
+
+
+def watch_pool():
+    # Wake the dispatcher as soon as a warm worker frees up
+    while not exit_event.is_set():
+        if pool.collect(1):
+            wake_event.set()
+
+
+def launch_bot(bot_id, owner):
     # Launch Bot
-    subprocess.Popen(f"python.exe trade.py {bot_id} -silent", shell=True)
+    if pool is not None:
+        if not pool.submit(bot_id, owner):
+            release_lock(bot_id, owner)
+    else:
+        subprocess.Popen(f"python.exe trade.py {bot_id} -silent -lock={owner}", shell=True)
 
 
 def service_main():
-    Lock.objects().delete()
+    global pool
+    ensure_lock_index()
+    Message.ensure_indexes()
+    if worker_mode == 'pool':
+        pool = WorkerPool(queue_config.getint('workers', 'pool_size', fallback=4),
+                          queue_config.getint('workers', 'max_jobs_per_worker', fallback=200),
+                          release_crashed_bot)
+        pool.start()
+        Thread(target=watch_pool, name="pool-watch", daemon=True).start()
+        print(f"Started {pool.size} warm workers.")
+    if queue_config.getboolean('retention', 'enabled', fallback=False):
+        Thread(target=retention_loop, name="retention", daemon=True).start()
+    if markets_cache.enabled:
+        Thread(target=markets_refresh_loop, name="markets-refresh", daemon=True).start()
+    if dispatch_mode == 'signal':
+        Thread(target=tail_signals, name="signal-tail", daemon=True).start()
+        print(f"Waiting for signals, sweeping every {sweep_interval}s.")
     print("QueueService running... press Ctrl+C to stop")
+    last_status = None
     while not exit_event.is_set():
-        for bot_id in Message.objects(status="pending").distinct(field="bot_id"):
-            # print(f"There are some pending messages for bot {bot_id}")
+        wake_event.clear()
+        pending = expire_stale(pending_work())
+        running = running_bots()
+        running_per_key = Counter(bot_keys.get(b) for b in running)
 
-            # Check for lock
-            if Lock.objects(bot_id=bot_id).first() is None:
-                # print(f"Launching bot {bot_id}")
+        depth = priority_classes.depth(pending)
+        status = " ".join(f"{name}={depth[name]}" for name in priority_classes.names)
+        status = f"Queue depth: {status} | running: {len(running)}"
+        if status != last_status:
+            print(status)
+            last_status = status
 
-                # Create Lock
-                b_lock = Lock(bot_id=bot_id).save()
-
-                launch_bot(bot_id)
-            else:
+        for work in pending:
+            bot_id = work['_id']
+            # print(f"There are {work['count']} pending messages for bot {bot_id}")
+            if work['locked']:
                 # print("bot is locked!")
-                pass
+                continue
+            if max_concurrent and len(running) >= max_concurrent:
+                break
+            if pool is not None and not pool.has_idle():
+                break
+            key = bot_keys.get(bot_id)
+            if max_per_key and key is not None and running_per_key[key] >= max_per_key:
+                continue
+
+            # Take the lock atomically, an expired lease is reclaimed
+            owner = new_owner()
+            if acquire_lock(bot_id, owner):
+                # print(f"Launching bot {bot_id}")
+                Message.objects(bot_id=bot_id, status="pending", dispatched_at=None) \
+                    .update(set__dispatched_at=datetime.utcnow())
+                launch_bot(bot_id, owner)
+                running.add(bot_id)
+                running_per_key[key] += 1
 
-        exit_event.wait(2)
+        wake_event.wait(sweep_interval)
     # Cleanup
-    print('Destroying all lock objects...')
-    Lock.objects().delete()
+    if pool is not None:
+        print('Stopping workers...')
+        pool.stop()
+    # Running trade.py processes keep renewing their own leases
     print('Bye!')
 
 
 def service_quit(signo, _frame):
     print(f"Interrupted by {signo}, shutting down...")
     exit_event.set()
+    wake_event.set()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,94 @@
+import time
+import hashlib
+from datetime import datetime
+from configparser import ConfigParser
+from mongoengine.connection import get_db
+from pymongo import ReturnDocument
+
+# Token buckets shared by every process talking to the exchange: trade workers,
+# warm pool workers and the SL adjuster. Each bucket is one Mongo document that is
+# refilled and drawn from in a single atomic update, so bots sharing an API key or
+# a proxy also share its request budget.
+
+budget_config = ConfigParser()
+budget_config.read("master_settings.ini")
+
+enabled = budget_config.getboolean('rate_limit', 'enabled', fallback=True)
+default_per_minute = budget_config.getfloat('rate_limit', 'default_per_minute', fallback=60)
+proxy_rate = budget_config.getfloat('rate_limit', 'proxy_rate', fallback=50)
+proxy_burst = budget_config.getfloat('rate_limit', 'proxy_burst', fallback=50)
+
+# Bybit limits private endpoints per account and endpoint, in requests per minute
+# (USDT perpetual v2 API). Public endpoints are only limited per IP, by the proxy bucket.
+ENDPOINT_LIMITS = [
+    ('linear/order/create', 100),
+    ('linear/order/cancel', 100),
+    ('linear/order/cancel-all', 100),
+    ('linear/order/replace', 100),
+    ('linear/stop-order/create', 100),
+    ('linear/stop-order/cancel', 100),
+    ('linear/stop-order/cancel-all', 100),
+    ('linear/stop-order/replace', 100),
+    ('linear/position/list', 120),
+    ('linear/position/set-leverage', 75),
+    ('linear/position/switch-isolated', 75),
+    ('linear/position/trading-stop', 75),
+    ('wallet/balance', 120),
+]
+max_wait = budget_config.getfloat('rate_limit', 'max_wait_seconds', fallback=10)
+
+
+def bucket_collection():
+    return get_db()['rate_bucket']
+
+
+def key_bucket(api_key):
+    # Never store the key itself
+    return f"key:{hashlib.sha1(api_key.encode()).hexdigest()[:16]}"
+
+
+def proxy_bucket(url):
+    return f"proxy:{url}"
+
+
+def endpoint_limit(path):
+    # (endpoint, rate per second, burst) of a private endpoint. A minute's allowance can
+    # go out at once, as the exchange allows, and refills at the published rate.
+    path = path.strip('/')
+    for endpoint, per_minute in ENDPOINT_LIMITS:
+        if path.endswith(endpoint):
+            return endpoint, per_minute / 60, per_minute
+    return 'other', default_per_minute / 60, default_per_minute
+
+
+def draw(name, rate, burst):
+    # Refill by elapsed time, then take a token if one is there. Returns the tokens left,
+    # negative when the draw was refused.
+    now = datetime.utcnow()
+    elapsed = {'$divide': [{'$subtract': [now, {'$ifNull': ['$updated_at', now]}]}, 1000]}
+    doc = bucket_collection().find_one_and_update({'_id': name}, [
+        {'$set': {'tokens': {'$min': [burst, {'$add': [{'$ifNull': ['$tokens', burst]},
+                                                       {'$multiply': [elapsed, rate]}]}]},
+                  'updated_at': now}},
+        {'$set': {'tokens': {'$cond': [{'$gte': ['$tokens', 1]}, {'$subtract': ['$tokens', 1]}, '$tokens']},
+                  'granted': {'$gte': ['$tokens', 1]}}},
+    ], upsert=True, return_document=ReturnDocument.AFTER)
+    return doc['tokens'] if doc['granted'] else doc['tokens'] - 1
+
+
+def acquire(name, rate, burst):
+    # Block until the bucket grants a token or max_wait runs out; returns seconds waited
+    waited = 0.0
+    while True:
+        tokens = draw(name, rate, burst)
+        if tokens >= 0 or waited >= max_wait:
+            return waited
+        delay = min(-tokens / rate, max_wait - waited)
+        time.sleep(delay)
+        waited += delay
+
+
+def penalize(name, burst):
+    # The exchange said slow down: empty the bucket so everyone sharing it backs off
+    bucket_collection().update_one({'_id': name}, {'$set': {'tokens': -burst, 'updated_at': datetime.utcnow()}},
+                                   upsert=True)
@@ -0,0 +1,151 @@
+import os
+import gzip
+import argparse
+from datetime import datetime, timedelta
+from configparser import ConfigParser
+from bson import json_util
+from mongoengine import connect
+from mongoengine.connection import get_db
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+# Read retention settings
+retention_config = ConfigParser()
+retention_config.read("queue_settings.ini")
+
+max_age_hours = retention_config.getfloat('retention', 'max_age_hours', fallback=24)
+target = retention_config.get('retention', 'target', fallback='collection')
+archive_dir = retention_config.get('retention', 'archive_dir', fallback='archive')
+archive_ttl_days = retention_config.getint('retention', 'archive_ttl_days', fallback=0)
+batch_size = retention_config.getint('retention', 'batch_size', fallback=5000)
+
+# Messages in these states are never touched again by the queue
+TERMINAL_STATUSES = ["success", "failed", "cancelled"]
+
+
+def hot_collection():
+    return get_db()['message']
+
+
+def archive_collection():
+    return get_db()['message_archive']
+
+
+def ensure_archive_indexes():
+    archive = archive_collection()
+    archive.create_index([('bot_id', ASCENDING), ('timestamp', DESCENDING)])
+    archive.create_index([('pair', ASCENDING), ('timestamp', DESCENDING)])
+    archive.create_index([('timestamp', DESCENDING)])
+    archive.create_index('group_id')
+    if archive_ttl_days > 0:
+        archive.create_index('archived_at', expireAfterSeconds=archive_ttl_days * 24 * 3600)
+
+
+def archive_to_collection(docs):
+    now = datetime.utcnow()
+    for doc in docs:
+        doc['archived_at'] = now
+    try:
+        archive_collection().insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # Documents copied by an interrupted earlier run are already there
+        if any(err['code'] != 11000 for err in e.details.get('writeErrors', [])):
+            raise
+
+
+def archive_to_files(docs):
+    os.makedirs(archive_dir, exist_ok=True)
+    by_day = {}
+    for doc in docs:
+        by_day.setdefault(doc['timestamp'].strftime('%Y-%m-%d'), []).append(doc)
+    for day, day_docs in by_day.items():
+        # Appending to a gzip file adds a new member, readers see one continuous stream
+        with gzip.open(os.path.join(archive_dir, f"messages-{day}.jsonl.gz"), 'at', encoding='utf-8') as f:
+            for doc in day_docs:
+                f.write(json_util.dumps(doc) + "\n")
+
+
+def archive_messages(max_age=None):
+    # Move finished messages older than max_age hours out of the hot collection, in batches
+    if max_age is None:
+        max_age = max_age_hours
+    cutoff = datetime.utcnow() - timedelta(hours=max_age)
+    query = {'status': {'$in': TERMINAL_STATUSES}, 'timestamp': {'$lt': cutoff}}
+    hot = hot_collection()
+    moved = 0
+    while True:
+        docs = list(hot.find(query).limit(batch_size))
+        if not docs:
+            break
+        if target == 'file':
+            archive_to_files(docs)
+        else:
+            archive_to_collection(docs)
+        hot.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+        moved += len(docs)
+        if len(docs) < batch_size:
+            break
+    return moved
+
+
+def query_archive(bot_id=None, pair=None, status=None, since=None, until=None, limit=100):
+    query = {}
+    if bot_id is not None:
+        query['bot_id'] = bot_id
+    if pair is not None:
+        query['pair'] = pair
+    if status is not None:
+        query['status'] = status
+    if since is not None or until is not None:
+        query['timestamp'] = {}
+        if since is not None:
+            query['timestamp']['$gte'] = since
+        if until is not None:
+            query['timestamp']['$lt'] = until
+
+    if target != 'file':
+        return list(archive_collection().find(query).sort('timestamp', DESCENDING).limit(limit))
+
+    # File archive: only open the days inside the window, newest first
+    results = []
+    if not os.path.isdir(archive_dir):
+        return results
+    for name in sorted(os.listdir(archive_dir), reverse=True):
+        if not (name.startswith("messages-") and name.endswith(".jsonl.gz")):
+            continue
+        day = datetime.strptime(name[len("messages-"):-len(".jsonl.gz")], '%Y-%m-%d')
+        if (since is not None and day + timedelta(days=1) <= since) or (until is not None and day >= until):
+            continue
+        with gzip.open(os.path.join(archive_dir, name), 'rt', encoding='utf-8') as f:
+            day_docs = [json_util.loads(line) for line in f]
+        for doc in sorted(day_docs, key=lambda d: d['timestamp'], reverse=True):
+            if all(doc.get(k) == v for k, v in query.items() if k != 'timestamp') and \
+                    (since is None or doc['timestamp'] >= since) and (until is None or doc['timestamp'] < until):
+                results.append(doc)
+                if len(results) >= limit:
+                    return results
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Message retention and archive queries.")
+    sub = parser.add_subparsers(dest='action', required=True)
+    run_parser = sub.add_parser('run', help="archive finished messages now")
+    run_parser.add_argument('--max-age-hours', type=float)
+    query_parser = sub.add_parser('query', help="search archived messages")
+    query_parser.add_argument('--bot')
+    query_parser.add_argument('--pair')
+    query_parser.add_argument('--status')
+    query_parser.add_argument('--since', type=datetime.fromisoformat)
+    query_parser.add_argument('--until', type=datetime.fromisoformat)
+    query_parser.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    connect('trade_db')
+    if args.action == 'run':
+        ensure_archive_indexes()
+        print(f"Archived {archive_messages(args.max_age_hours)} messages.")
+    else:
+        for doc in query_archive(args.bot, args.pair, args.status, args.since, args.until, args.limit):
+            print(f"{doc['timestamp']}  bot {doc['bot_id']:<5} {doc['pair']:<12} {doc['command']:<20} "
+                  f"{doc.get('status')}  {doc.get('error_msg') or ''}")
@@ -0,0 +1,104 @@
+import time
+import random
+from urllib.parse import urlsplit
+from configparser import ConfigParser
+from ccxt.base.errors import NetworkError, DDoSProtection, InvalidNonce
+
+import rate_budget
+from call_timing import set_attempt
+
+# Retries for every exchange request of a ccxt client, in front of the shared
+# rate budget. Only failures that retrying can fix are retried:
+#   throttled  - DDoSProtection/RateLimitExceeded: the request was refused, always retry,
+#                and drain the shared buckets so other bots on the key or proxy back off
+#   rejected   - InvalidNonce: refused for its timestamp, always retry (it is re-signed)
+#   network    - timeouts and other NetworkErrors: retry reads only, a write may have executed
+# Anything else (bad params, auth, insufficient funds, ...) fails at once.
+
+retry_config = ConfigParser()
+retry_config.read("master_settings.ini")
+
+max_attempts = retry_config.getint('retry', 'max_attempts', fallback=4)
+base_delay = retry_config.getfloat('retry', 'base_delay', fallback=0.25)
+max_delay = retry_config.getfloat('retry', 'max_delay', fallback=5)
+
+
+def classify(error):
+    if isinstance(error, DDoSProtection):
+        return 'throttled'
+    if isinstance(error, InvalidNonce):
+        return 'rejected'
+    if isinstance(error, NetworkError):
+        return 'network'
+    return 'fatal'
+
+
+def should_retry(kind, method):
+    if kind in ('throttled', 'rejected'):
+        return True
+    return kind == 'network' and method == 'GET'
+
+
+def backoff(attempt, kind):
+    # Full jitter: anywhere between 0 and the exponential cap, throttling starts higher
+    cap = min(max_delay, base_delay * (4 if kind == 'throttled' else 1) * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+class ExchangePolicy:
+    def __init__(self, exchange, api_key=None, proxy=None):
+        # Private requests draw from the key's bucket for their endpoint, every request from the proxy's
+        self.key = rate_budget.key_bucket(api_key) if rate_budget.enabled and api_key else None
+        self.proxy = None
+        if rate_budget.enabled and proxy:
+            self.proxy = (rate_budget.proxy_bucket(proxy), rate_budget.proxy_rate, rate_budget.proxy_burst)
+        # Generated endpoint methods bind request() from the class, but request() calls
+        # self.fetch2(), which signs and sends; wrapped on the instance, a retry is re-signed
+        self.fetch2 = exchange.fetch2
+        self.fetch = exchange.fetch
+        exchange.fetch2 = self.retried_fetch2
+        exchange.fetch = self.budgeted_fetch
+
+    def buckets(self, path, private):
+        buckets = []
+        if self.key and private:
+            endpoint, rate, burst = rate_budget.endpoint_limit(path)
+            buckets.append((f"{self.key}:{endpoint}", rate, burst))
+        if self.proxy:
+            buckets.append(self.proxy)
+        return buckets
+
+    def budgeted_fetch(self, url, method='GET', headers=None, body=None):
+        path = urlsplit(url).path
+        for name, rate, burst in self.buckets(path, '/public/' not in path):
+            try:
+                rate_budget.acquire(name, rate, burst)
+            except Exception as e:
+                # The budget is a courtesy, never a reason to miss a trade
+                print(f"Rate budget unavailable: {e}")
+                break
+        return self.fetch(url, method, headers, body)
+
+    def retried_fetch2(self, path, api='public', method='GET', *args, **kwargs):
+        attempt = 0
+        while True:
+            set_attempt(attempt)
+            try:
+                return self.fetch2(path, api, method, *args, **kwargs)
+            except Exception as e:
+                kind = classify(e)
+                attempt += 1
+                if attempt >= max_attempts or not should_retry(kind, method):
+                    raise
+                if kind == 'throttled':
+                    private = 'private' in (api if isinstance(api, (list, tuple)) else [api])
+                    for name, rate, burst in self.buckets(path, private):
+                        try:
+                            rate_budget.penalize(name, burst)
+                        except Exception:
+                            pass
+                delay = backoff(attempt, kind)
+                print(f"{type(e).__name__} on {method} {path}, retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+            finally:
+                set_attempt(0)
@@ -0,0 +1,53 @@
+import os
+import csv
+from collections import Counter
+
+
+class PriorityClasses:
+    """Maps commands to urgency classes read from the [priority] settings section."""
+
+    OTHER = 'other'
+
+    def __init__(self, config):
+        self.names = []
+        self.rank_of = {}
+        if 'priority' in config.sections():
+            for name, commands in config['priority'].items():
+                self.names.append(name)
+                for command in commands.split(","):
+                    self.rank_of[command.strip().lower()] = len(self.names) - 1
+        self.names.append(self.OTHER)
+
+    def rank(self, command):
+        return self.rank_of.get(command.lower(), len(self.names) - 1)
+
+    def bot_rank(self, work):
+        # A bot runs its whole queue in order, so it is as urgent as its most urgent message
+        return min(self.rank(c['command']) for c in work['commands'])
+
+    def depth(self, pending):
+        depth = Counter({name: 0 for name in self.names})
+        for work in pending:
+            for c in work['commands']:
+                depth[self.names[self.rank(c['command'])]] += c['count']
+        return depth
+
+
+class BotKeys:
+    """bot id -> api key from keys.csv, reloaded when the file changes."""
+
+    def __init__(self, path='keys.csv'):
+        self.path = path
+        self.mtime = None
+        self.keys = {}
+
+    def get(self, bot_id):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        if mtime != self.mtime:
+            with open(self.path, newline='') as f:
+                self.keys = {row['botid'].strip(): row['key'] for row in csv.DictReader(f)}
+            self.mtime = mtime
+        return self.keys.get(bot_id)
@@ -7,6 +7,10 @@ from pprint import pprint
 
 import pandas as pd
 from configparser import ConfigParser
+import markets_cache
+from mongoengine import connect
+from retry_policy import ExchangePolicy
+from exchange_loader import point_at_simulator
 
 # Read Settings CSV
 df = pd.read_csv('sl_settings.csv')
@@ -20,6 +24,7 @@ proxy_df = pd.read_csv('proxies.csv')
 # Read master settings
 master_config = ConfigParser()
 master_config.read("master_settings.ini")
+simulator = master_config.get('main', 'simulator', fallback='')
 
 # Read Adjuster Settings
 adj_config = ConfigParser()
@@ -62,6 +67,7 @@ def set_sl(bot_id, pair, side, sl):
 
         # Read Proxy Row
         proxy_row = proxy_df.loc[proxy_df['botid'] == bot_id]
+        url = None
         if len(proxy_row) == 1:
             url = proxy_row['url'].values[0]
             print(f"Using proxy: {url}")
@@ -69,8 +75,14 @@ def set_sl(bot_id, pair, side, sl):
                 'https': url
             }
 
+        if simulator:
+            point_at_simulator(bybit, simulator)
+
+        # Share the request budget of this key and proxy with the trade workers
+        ExchangePolicy(bybit, bot_key, url)
+
         print(f"Loading market data...")
-        markets = bybit.load_markets()
+        markets = markets_cache.load_markets(bybit)
         market = bybit.market(pair)
         symbol = market['id']
 
@@ -114,6 +126,7 @@ def get_position(bot_id, pair):
 
         # Read Proxy Row
         proxy_row = proxy_df.loc[proxy_df['botid'] == bot_id]
+        url = None
         if len(proxy_row) == 1:
             url = proxy_row['url'].values[0]
             print(f"Using proxy: {url}")
@@ -121,8 +134,14 @@ def get_position(bot_id, pair):
                 'https': url
             }
 
+        if simulator:
+            point_at_simulator(bybit, simulator)
+
+        # Share the request budget of this key and proxy with the trade workers
+        ExchangePolicy(bybit, bot_key, url)
+
         print(f"Loading market data...")
-        markets = bybit.load_markets()
+        markets = markets_cache.load_markets(bybit)
         market = bybit.market(pair)
         symbol = market['id']
 
@@ -318,6 +337,9 @@ def service_quit(signo, _frame):
 if __name__ == '__main__':
     print(df.to_string())
 
+    # Rate budgets are kept in the trade database
+    connect('trade_db')
+
     # Handle termination signals
     import signal
 
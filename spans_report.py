@@ -0,0 +1,44 @@
+import json
+import argparse
+from datetime import datetime
+
+# Latency percentiles of raw exchange call spans (see [instrumentation] in master_settings.ini),
+# grouped by endpoint, proxy or both.
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * (len(values) - 1)))]
+
+
+def read_spans(path, since=None):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            span = json.loads(line)
+            if since is None or datetime.fromisoformat(span['at']) >= since:
+                yield span
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Exchange call latency by endpoint and proxy.")
+    parser.add_argument('path')
+    parser.add_argument('--by', default='endpoint', help="comma separated span fields, e.g. endpoint,proxy")
+    parser.add_argument('--since', type=datetime.fromisoformat)
+    args = parser.parse_args()
+    by = [field for field in args.by.split(',') if field]
+
+    groups = {}
+    for span in read_spans(args.path, args.since):
+        group = groups.setdefault(tuple(str(span.get(field)) for field in by), {'ms': [], 'errors': 0, 'retries': 0})
+        group['ms'].append(span['ms'])
+        group['errors'] += span['status'] != "ok"
+        group['retries'] += span.get('attempt', 0) > 0
+
+    print(f"{' '.join(by):<60} {'n':>6} " + " ".join(f"{'p' + str(p):>8}" for p in PERCENTILES)
+          + f" {'max':>8} {'errors':>6} {'retries':>7}   (ms)")
+    # Worst tail first
+    for key, group in sorted(groups.items(), key=lambda g: -percentile(sorted(g[1]['ms']), 99)):
+        values = sorted(group['ms'])
+        print(f"{' '.join(key):<60} {len(values):>6} "
+              + " ".join(f"{percentile(values, p):>8}" for p in PERCENTILES)
+              + f" {values[-1]:>8} {group['errors']:>6} {group['retries']:>7}")
@@ -0,0 +1,39 @@
+import json
+
+import bybit_sim
+import retry_policy
+from call_timing import CallTimer
+from exchange_loader import load_bybit, point_at_simulator
+
+
+def test_retried_call_records_attempts(monkeypatch, tmp_path):
+    monkeypatch.setattr(retry_policy, 'base_delay', 0.001)
+    monkeypatch.setattr(retry_policy, 'max_attempts', 3)
+    sim = bybit_sim.Simulator(error_rate=1.0, errors=['rate_limit'])
+    server, url = bybit_sim.start(sim)
+    exchange = load_bybit()({'apiKey': "test", 'secret': "test", 'enableRateLimit': False})
+    point_at_simulator(exchange, url)
+    spans_path = tmp_path / "spans.jsonl"
+    timer = CallTimer(exchange, str(spans_path))
+    retry_policy.ExchangePolicy(exchange)
+
+    timer.begin(message_id="test")
+    try:
+        # A generated endpoint method, which ccxt 1.55 binds to request() from the class
+        if hasattr(exchange, 'v2_public_get_time'):
+            exchange.v2_public_get_time()
+        else:
+            exchange.public_get_v5_market_time()
+    except Exception:
+        pass
+    finally:
+        server.shutdown()
+    summary = timer.end()
+
+    assert summary['calls'] == 3
+    assert summary['retries'] == 2
+    assert summary['errors'] == 3
+    endpoint, = summary['endpoints'].values()
+    assert endpoint['retries'] == 2
+    spans = [json.loads(line) for line in spans_path.read_text().splitlines()]
+    assert [span['attempt'] for span in spans] == [0, 1, 2]
@@ -0,0 +1,29 @@
+from collections import namedtuple
+from configparser import ConfigParser
+
+from coalesce import CoalesceRules
+
+Command = namedtuple('Command', 'pair command')
+
+
+def rules():
+    config = ConfigParser()
+    config.read_string("[coalesce]\n"
+                       "exit-long: enter-long, take-profit-long-1, take-profit-long-2\n"
+                       "exit-short: enter-short, take-profit-short-1, take-profit-short-2\n")
+    return CoalesceRules(config)
+
+
+def test_exit_cancels_the_commands_directly_before_it():
+    enter, take_profit, other, exit_ = (Command("BTC/USDT", "enter-long"), Command("BTC/USDT", "take-profit-long-1"),
+                                        Command("ETH/USDT", "enter-long"), Command("BTC/USDT", "exit-long"))
+    kept, cancelled = rules().plan([enter, take_profit, other, exit_])
+    assert kept == [other, exit_]
+    assert cancelled == [(enter, exit_), (take_profit, exit_)]
+
+
+def test_exit_keeps_an_enter_with_another_command_for_the_pair_in_between():
+    messages = [Command("BTC/USDT", "enter-long"), Command("BTC/USDT", "enter-short"), Command("BTC/USDT", "exit-long")]
+    kept, cancelled = rules().plan(messages)
+    assert kept == messages
+    assert cancelled == []
@@ -0,0 +1,47 @@
+import mongoengine
+import mongomock
+import pytest
+
+import commands
+import webhook
+
+
+@pytest.fixture
+def client(monkeypatch):
+    mongoengine.disconnect()
+    mongoengine.connect('trade_db', mongo_client_class=mongomock.MongoClient)
+    monkeypatch.setattr(webhook, 'ingest_buffer', None)
+    monkeypatch.setattr(webhook, 'dedupe_cache', webhook.TTLCache(120))
+    yield webhook.app.test_client()
+    mongoengine.disconnect()
+
+
+def test_failed_signal_keeps_the_alert_stored_and_deduped(client, monkeypatch):
+    def fail(self, *args, **kwargs):
+        raise RuntimeError("signal collection unavailable")
+    monkeypatch.setattr(webhook.Signal, 'save', fail)
+
+    assert client.post('/webhook', data={'command': "1_BTC/USDT_enter-long"}).status_code == 200
+    # TradingView's re-send is dropped instead of queueing the trade twice
+    response = client.post('/webhook', data={'command': "1_BTC/USDT_enter-long"})
+    assert response.get_data(as_text=True) == 'duplicate'
+    assert webhook.Message.objects.count() == 1
+
+
+def test_alert_without_command_is_rejected(client):
+    rejected = webhook.requests_total.get('bad_request')
+    assert client.post('/webhook', data={}).status_code == 400
+    assert webhook.requests_total.get('bad_request') == rejected + 1
+    assert webhook.Message.objects.count() == 0
+
+
+def test_batch_with_unknown_command_is_rejected(client):
+    response = client.post('/webhook/batch', json=["1_BTC/USDT_enter-long", "1_BTC/USDT_enter-sideways"])
+    assert response.status_code == 400
+    assert "unknown command 'enter-sideways'" in response.get_json()['errors'][0]
+    assert webhook.Message.objects.count() == 0
+
+
+def test_command_names_match_the_trade_handlers():
+    import trade
+    assert set(trade.COMMANDS) == commands.NAMES
@@ -1,14 +1,40 @@
+from datetime import datetime
+started_at = datetime.utcnow()
 import sys
 import json
 import time
-from datetime import datetime, timedelta
-import ccxt
-from ccxt import ExchangeError
-from pprint import pprint
-import pandas as pd
+import contextvars
+from threading import Lock, RLock
+from concurrent.futures import ThreadPoolExecutor
+from exchange_loader import load_bybit, point_at_simulator
+bybit_class = load_bybit()
+from ccxt.base.errors import ExchangeError
 
 from mongoengine import *
 from configparser import ConfigParser
+import locks
+from locks import LockHeartbeat
+from coalesce import CoalesceRules
+import markets_cache
+from csv_index import CsvIndex
+import margin_cache
+from call_timing import CallTimer
+import retry_policy
+from bot_config import BotConfigs, BotConfigError
+
+verbose = True
+# Call timer of the client working on the current bot
+current_timer = None
+
+# Pairs of one bot run sequentially or side by side
+execution_config = ConfigParser()
+execution_config.read("master_settings.ini")
+pair_mode = execution_config.get('execution', 'pairs', fallback='sequential')
+max_pairs = execution_config.getint('execution', 'max_pairs', fallback=4)
+
+# Compiled bots/<id>.ini, kept across runs of a warm worker until the file changes
+bot_configs = BotConfigs()
+
 
 # MongoEngine Schema
 class Message(Document):
@@ -20,10 +46,28 @@ class Message(Document):
     status = StringField(default="pending")
     error_msg = StringField()
     error_severity = StringField()
-
-
-class Lock(Document):
-    bot_id = StringField(required=True)
+    group_id = StringField()
+    dedupe_key = StringField()
+    dispatched_at = DateTimeField()
+    worker_started_at = DateTimeField()
+    exchange_first_call_at = DateTimeField()
+    order_ack_at = DateTimeField()
+    finished_at = DateTimeField()
+    timings = DictField()
+    tp_orders = ListField(DictField())
+    call_summary = DictField()
+
+    meta = {
+        'indexes': [('status', 'bot_id', 'timestamp')],
+        'auto_create_index': False,
+    }
+
+
+class Signal(Document):
+    # Capped collection tailed by the queue service to wake up on new work
+    bot_ids = ListField(StringField())
+    timestamp = DateTimeField(default=datetime.utcnow)
+    meta = {'max_documents': 10000, 'max_size': 4 * 1024 * 1024}
 
 
 def get_error_json(e: ExchangeError):
@@ -32,6 +76,9 @@ def get_error_json(e: ExchangeError):
 
 
 def log_error(msg, text, severity):
+    msg.finished_at = datetime.utcnow()
+    if current_timer is not None:
+        msg.call_summary = current_timer.end()
     if severity == "warn":
         cprint(f"ERROR: {text}", BColors.WARNING)
     else:
@@ -44,38 +91,23 @@ def log_error(msg, text, severity):
 
 
 def log_success(msg, text):
+    msg.finished_at = datetime.utcnow()
+    if current_timer is not None:
+        msg.call_summary = current_timer.end()
     cprint(text, BColors.OKGREEN)
     msg.status = "success"
     msg.save()
 
 
-def release_lock(lock_id):
-    lock = Lock.objects(bot_id=lock_id).first()
-    if lock is None:
+def release_lock(lock_id, owner=None):
+    if not locks.release_lock(lock_id, owner):
         print("Process was initiated without locking. this is NOT recommended, "
               "make sure you are running the script via QueueService!")
     else:
         if verbose:
             print("Releasing lock...")
-        lock.delete()
-
-
-def do_with_retry(func, *args):
-    number_of_tries = 3
-    current_try = 0
-    timeout = 5
-    last_e = None
-    while current_try < number_of_tries:
-        try:
-            # try to do it
-            func(*args)
-            return
-        except Exception as e:
-            last_e = e
-            current_try += 1
-            print(f"Trying again in {timeout} seconds.")
-            time.sleep(timeout)
-    raise last_e
+        # Let the queue service pick up messages that arrived while this bot was running
+        Signal(bot_ids=[lock_id]).save()
 
 
 class BColors:
@@ -96,102 +128,21 @@ def cprint(text, color):
 # def critical_error_handler():
 #     # When critical error happens all of the messages get failed
 #     objs = Message.objects(bot_id=bot_id, status="pending")
-def get_position(bybit, bot_id, pair):
-    try:
-        # Get current price
-        response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-        index_price = float(response['result'][0]['price'])
-
-        # Check for current positions
-        response = bybit.fetch_positions(symbols=[pair])
-
-        have_buy_position = False
-        have_sell_position = False
-        buy_qty = None
-        sell_qty = None
-        buy_sl = None
-        sell_sl = None
-        buy_upnl = None
-        sell_upnl = None
-        buy_entry = None
-        sell_entry = None
-        buy_leverage = None
-        sell_leverage = None
-
-        if len(response) != 2:
-            raise Exception("error getting active positions")
-
-        for p in response:
-            side = p['side']
-            if p['side'] == "Sell" and float(p['size']) != 0.0:
-                have_sell_position = True
-                sell_qty = float(p['size'])
-                sell_sl = float(p['stop_loss'])
-                sell_upnl = float(p['unrealised_pnl'])
-                sell_entry = float(p['entry_price'])
-                sell_leverage = float(p['leverage'])
-
-                # response = bybit.fetch_ticker(pair)
-                # index_price = float(response['high'])
-
-            if p['side'] == "Buy" and float(p['size']) != 0.0:
-                have_buy_position = True
-                buy_qty = float(p['size'])
-                buy_sl = float(p['stop_loss'])
-                buy_upnl = float(p['unrealised_pnl'])
-                buy_entry = float(p['entry_price'])
-                buy_leverage = float(p['leverage'])
-
-                # response = bybit.fetch_ticker(pair)
-                # index_price = float(response['high'])
-
-        if not have_buy_position and not have_sell_position:
-            return False, 'no', 0, 0, 0, 0, 0, 'no'
-        elif have_buy_position and not have_sell_position:
-            return True, 'long', buy_qty, buy_sl, buy_upnl, buy_entry, index_price, side
-        elif not have_buy_position and have_sell_position:
-            return True, 'short', sell_qty, sell_sl, sell_upnl, sell_entry, index_price, side
-        else:
-            raise Exception("impossible !")
-
-    except Exception as e:
-        print(e)
-        return False, 'no', 0, 0, 0, 0, 0
-
-if __name__ == '__main__':
-    bot_id = sys.argv[1]
-
-    verbose = True
-    if len(sys.argv) == 3 and sys.argv[2] == "-silent":
-        verbose = False
-    verbose = True
-    if verbose:
-        cprint(f"BotID: {bot_id}", BColors.OKBLUE)
-
-    config = ConfigParser()
-    config.read(f"bots/{bot_id}.ini")
-
-    # Connect to DB
-    connect('trade_db')
-    if verbose:
-        print("Message database connected!")
 
-    # Read Key CSV
-    key_df = pd.read_csv('keys.csv')
 
+def make_client(bot_id):
     # Read Key/Secret Row
-    key_row = key_df.loc[key_df['botid'] == int(bot_id)]
-    if len(key_row) != 1:
+    key_row = CsvIndex('keys.csv').get(bot_id)
+    if key_row is None:
         cprint(f"ERROR: no auth for bot {bot_id} in csv. whole service will die.", BColors.FAIL)
-        release_lock(bot_id)
-        sys.exit(-1)
+        return None
 
-    bot_key = key_row['key'].values[0]
-    bot_secret = key_row['secret'].values[0]
+    bot_key = key_row['key']
+    bot_secret = key_row['secret']
 
     # print(f"Key: {bot_key} , Secret: {bot_secret}")
 
-    bybit = ccxt.bybit({
+    bybit = bybit_class({
         'apiKey': bot_key,
         'secret': bot_secret,
         'enableRateLimit': True,
@@ -200,13 +151,10 @@ if __name__ == '__main__':
         }
     })
 
-    # Read proxies CSV
-    proxy_df = pd.read_csv('proxies.csv')
-
     # Read Proxy Row
-    proxy_row = proxy_df.loc[proxy_df['botid'] == int(bot_id)]
-    if len(proxy_row) == 1:
-        url = proxy_row['url'].values[0]
+    proxy_row = CsvIndex('proxies.csv').get(bot_id)
+    if proxy_row is not None:
+        url = proxy_row['url']
         if verbose:
             print(f"Using proxy: {url}")
         bybit.proxies = {
@@ -220,699 +168,648 @@ if __name__ == '__main__':
         if verbose:
             print(f"Operating in sandbox mode.")
         bybit.set_sandbox_mode(True)
+    simulator = master_config.get('main', 'simulator', fallback='')
+    if simulator:
+        if verbose:
+            print(f"Trading against the simulator at {simulator}.")
+        point_at_simulator(bybit, simulator)
 
-    max_webhook_message_age_time = 90
-    max_order_time = 60
-    if 'timing' in config.sections() and 'max_webhook_message_age_time' in config['timing']:
-        max_webhook_message_age_time = int(config['timing']['max_webhook_message_age_time'])
-    if 'timing' in config.sections() and 'max_order_time' in config['timing']:
-        max_order_time = int(config['timing']['max_order_time'])
+    # Time every REST call, optionally keeping the raw spans
+    CallTimer(bybit, master_config.get('instrumentation', 'spans_file', fallback='') or None)
+    # Retries and the request budget shared with other bots on this key and proxy
+    retry_policy.ExchangePolicy(bybit, bot_key, proxy_row['url'] if proxy_row is not None else None)
 
-    objs = Message.objects(bot_id=bot_id, status="pending").order_by('+timestamp')
-    if len(objs) == 0:
-        if verbose:
-            print("There are no messages to process. exiting...")
-        release_lock(bot_id)
-        sys.exit(-1)
+    return bybit
 
-    if verbose:
-        print(f"Loading market data...")
-    markets = bybit.load_markets()
 
-    for i, msg in enumerate(objs):
-        if verbose:
-            print("---------------------------")
-            print(f"Processing message {i + 1}/{len(objs)} for this bot.")
-            print(f"Timestamp: {msg.timestamp}")
-        pair = msg.pair.upper()
-        command = msg.command.lower()
-        print(f"command={command}")
-        start_time = datetime.utcnow()
-
-        try:
-            # Check message expire
-            if (datetime.utcnow() - msg.timestamp).seconds >= max_webhook_message_age_time:
-                raise Exception(f"max_webhook_message_age_time expired for message. ({max_webhook_message_age_time}s)",
-                                "warn")
-
-            market = bybit.market(pair)
-            symbol = market['id']
-            base = market['base']
-
-            if command == "enter-short":
-                if verbose:
-                    print(f"Entering short position in {pair}")
-
-                # Check for current positions
-                response = bybit.fetch_positions(symbols=[pair])
-                have_buy_position = False
-                have_sell_position = False
-                if len(response) != 2:
-                    raise Exception("error getting active positions")
-
-                for p in response:
-                    if p['side'] == "Sell" and float(p['size']) != 0.0:
-                        have_sell_position = True
-                    if p['side'] == "Buy" and float(p['size']) != 0.0:
-                        have_buy_position = True
-                if have_buy_position or have_sell_position:
-                    raise Exception("this bot already has a position open.", "warn")
-                else:
-                    # Set Leverage Value
-                    leverage = float(config['trade'][f"{pair}_leverage_multiple"])
-                    is_isolated = config['trade'][f"{pair}_is_isolated"] == "true"
+POSITIONS = 'positions'
+PRICE = 'price'
+BALANCE = 'balance'
+# Not account state: the pair's compiled settings from bots/<id>.ini
+SETTINGS = 'settings'
 
-                    if verbose:
-                        print("Setting Cross/Isolated...")
-                        print(f"is_isolated value: {is_isolated}")
-
-                    try:
-                        response = bybit.private_linear_post_position_switch_isolated({"symbol": symbol,
-                                                                                       "is_isolated": is_isolated,
-                                                                                       "buy_leverage": leverage,
-                                                                                       "sell_leverage": leverage})
-                    except ExchangeError as e:
-                        err_json = get_error_json(e)
-                        if err_json['ret_code'] == 130056:
-                            if verbose:
-                                print("Cross/Isolated already at the desired value.")
-                        else:
-                            raise Exception("error setting Cross/Isolated.")
+# direction -> (side that opens it, side that closes it)
+SIDES = {'long': ("Buy", "Sell"), 'short': ("Sell", "Buy")}
 
-                    if verbose:
-                        print(f"Leverage value: {leverage}")
-                        print(f"Setting leverage...")
-                    try:
-                        response = bybit.private_linear_post_position_set_leverage({"symbol": symbol,
-                                                                                    "buy_leverage": leverage,
-                                                                                    "sell_leverage": leverage})
-                    except ExchangeError as e:
-                        err_json = get_error_json(e)
-                        if err_json['ret_code'] == 34036:
-                            if verbose:
-                                print("Leverage already at the desired value.")
-                        else:
-                            raise Exception("error setting leverage.")
-
-                    # Get Portfolio Value
-                    if verbose:
-                        print("Getting portfolio...")
-                    response = bybit.fetch_balance()
-                    usdt_portfolio = float(response['USDT']['free'])
-                    if verbose:
-                        print(f"Available USDT Portfolio Value: {usdt_portfolio}")
-                    invest_precent = float(config['trade'][f"{pair}_portfolio_percent"])
-                    if verbose:
-                        print(f"Portfolio percentage: {invest_precent}%")
 
-                    # Get Latest price for symbol
-                    response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-                    index_price = float(response['result'][0]['price'])
-                    if verbose:
-                        print(f"Price for {base}: {index_price}")
+call_pool = None
+pair_pool = None
+# Timings dict of the message being processed in the current context
+message_timings = contextvars.ContextVar('message_timings', default=None)
 
-                    # Calculate Qty
-                    position_qty = round((usdt_portfolio * leverage * (invest_precent / 100)) / index_price, 2)
-                    if verbose:
-                        print(f"Position qty: {position_qty}")
-
-                    # Check max_order_time
-                    if (datetime.utcnow() - start_time).seconds >= max_order_time:
-                        raise Exception("max_order_time expired.", "warn")
-
-                    # response = bybit.create_order(pair, "Market", "Sell", position_qty)
-
-                    # Set Stop Loss
-                    sl_price = None
-                    if f"{pair}_stop_loss" in config['trade']:
-                        sl_percent = float(config['trade'][f"{pair}_stop_loss"])
-                        sl_price = round(((100 + sl_percent) / 100) * index_price, 2)  # in short its bigger than entry
-                        if verbose:
-                            print(f"SL Price: {sl_price}")
-                    
-                    if sl_price is not None:
-                        response = bybit.private_linear_post_order_create({"symbol": symbol,
-                                                                           "side": "Sell",
-                                                                           "order_type": "Market",
-                                                                           "qty": position_qty,
-                                                                           "time_in_force": "GoodTillCancel",
-                                                                           "close_on_trigger": False,
-                                                                           "reduce_only": False,
-                                                                           "stop_loss": sl_price})
-                    else:
-                        response = bybit.private_linear_post_order_create({"symbol": symbol,
-                                                                           "side": "Sell",
-                                                                           "order_type": "Market",
-                                                                           "qty": position_qty,
-                                                                           "time_in_force": "GoodTillCancel",
-                                                                           "close_on_trigger": False,
-                                                                           "reduce_only": False})
-
-                    # Read Take Profit Setting
-                    tps = []
-                    tpc = 1
-                    total_percentage = 0.0
-                    while f"{pair}_tp_{tpc}_%" in config['trade']:
-                        tp_percent = float(config['trade'][f"{pair}_tp_{tpc}_%"])
-                        tp_percent_of_position = float(config['trade'][f"{pair}_tp_{tpc}_%_of_position"])
-                        total_percentage += tp_percent_of_position
-                        tps.append((tp_percent, tp_percent_of_position))
-                        tpc += 1
-
-                    if len(tps) > 0 and total_percentage != 100.0:
-                        raise Exception("sum of take profit percents should be 100.")
-
-                    for tp in tps:
-                        tp_qty = (tp[1] / 100) * position_qty
-                        tp_price = round(((100 - tp[0]) / 100) * index_price, 2)  # for short its less than entry
-                        if verbose:
-                            print("Setting Take Profit...")
-                            print(f"TP Qty : {tp_qty}   TP Price: {tp_price}")
-                        response = bybit.privateLinearPostStopOrderCreate({"symbol": symbol,
-                                                                           "side": "Buy",
-                                                                           "order_type": "Market",
-                                                                           "qty": tp_qty,
-                                                                           "base_price": index_price,
-                                                                           "stop_px": tp_price,
-                                                                           "time_in_force": "GoodTillCancel",
-                                                                           "trigger_by": "LastPrice",
-                                                                           "close_on_trigger": True,
-                                                                           "reduce_only": True
-                                                                           })
-
-                    log_success(msg, "Position opened successfully.")
-
-            elif command == "enter-long":
-                if verbose:
-                    print(f"Entering long position in {pair}")
-
-                # Check for current positions
-                response = bybit.fetch_positions(symbols=[pair])
-                have_buy_position = False
-                have_sell_position = False
-                if len(response) != 2:
-                    raise Exception("error getting active positions")
-
-                for p in response:
-                    if p['side'] == "Sell" and float(p['size']) != 0.0:
-                        have_sell_position = True
-                    if p['side'] == "Buy" and float(p['size']) != 0.0:
-                        have_buy_position = True
-                if have_buy_position or have_sell_position:
-                    raise Exception("this bot already has a position open.", "warn")
-                else:
 
-                    # Set Leverage Value
-                    leverage = float(config['trade'][f"{pair}_leverage_multiple"])
-                    is_isolated = config['trade'][f"{pair}_is_isolated"] == "true"
+def submit_call(func, *args, **kwargs):
+    # Shared worker threads for exchange calls that don't depend on each other.
+    # The call runs in a copy of the caller's context so it is timed on the caller's message.
+    global call_pool
+    if call_pool is None:
+        call_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="exchange")
+    return call_pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
 
-                    if verbose:
-                        print("Setting Cross/Isolated...")
-                        print(f"is_isolated value: {is_isolated}")
-
-                    try:
-                        response = bybit.private_linear_post_position_switch_isolated({"symbol": symbol,
-                                                                                       "is_isolated": is_isolated,
-                                                                                       "buy_leverage": leverage,
-                                                                                       "sell_leverage": leverage})
-                    except ExchangeError as e:
-                        err_json = get_error_json(e)
-                        if err_json['ret_code'] == 130056:
-                            if verbose:
-                                print("Cross/Isolated already at the desired value.")
-                        else:
-                            raise Exception("error setting Cross/Isolated.")
-
-                    # Set Leverage Value
-                    if verbose:
-                        print(f"Leverage value: {leverage}")
-                        print(f"Setting leverage...")
-                    try:
-                        response = bybit.private_linear_post_position_set_leverage({"symbol": symbol,
-                                                                                    "buy_leverage": leverage,
-                                                                                    "sell_leverage": leverage})
-                    except ExchangeError as e:
-                        err_json = get_error_json(e)
-                        if err_json['ret_code'] == 34036:
-                            if verbose:
-                                print("Leverage already at the desired value.")
-                        else:
-                            raise Exception("error setting leverage.")
-
-                    # Get Portfolio Value
-                    if verbose:
-                        print("Getting portfolio...")
-                    response = bybit.fetch_balance()
-                    usdt_portfolio = float(response['USDT']['free'])
-                    if verbose:
-                        print(f"Available USDT Portfolio Value: {usdt_portfolio}")
-                    invest_precent = float(config['trade'][f"{pair}_portfolio_percent"])
-                    if verbose:
-                        print(f"Portfolio percentage: {invest_precent}%")
 
-                    # Get Latest price for symbol
-                    response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-                    index_price = float(response['result'][0]['price'])
-                    if verbose:
-                        print(f"Price for {base}: {index_price}")
+def timed_call(timings, name, func, *args, **kwargs):
+    # Adds the call's wall time in ms to timings[name]
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[name] = round(timings.get(name, 0) + (time.perf_counter() - start) * 1000, 1)
+
+
+class AccountState:
+    """Positions, prices and free balance fetched once per batch of messages.
+
+    Handlers read state through this object, which only calls the exchange when a
+    value is missing or older than max_age seconds, and record the effect of their
+    own orders on it so the next message of the batch does not fetch it again.
+    prefetch() starts the missing reads in parallel; a read blocks only on its own.
+    """
+
+    def __init__(self, bybit, max_age):
+        self.bybit = bybit
+        self.max_age = max_age
+        self.values = {}
+        self.pending = {}
+        # Bumped by drop(): a read that started before it must not put its old value back
+        self.generations = {}
+        self.lock = Lock()
+        self.sizing_lock = RLock()
+
+    def begin(self, msg):
+        # Calls made from now on in this pair's context are timed on this message
+        msg.timings = {}
+        message_timings.set(msg.timings)
+
+    @property
+    def timings(self):
+        timings = message_timings.get()
+        return timings if timings is not None else {}
+
+    def cached(self, kind, pair):
+        entry = self.values.get((kind, pair))
+        if entry is None or time.monotonic() - entry[1] > self.max_age:
+            return None
+        return entry[0]
+
+    def load(self, kind, pair, timings):
+        key = (kind, pair)
+        generation = self.generations.get(key, 0)
+        value = self.fetchers[kind](self, pair, timings)
+        with self.lock:
+            if self.generations.get(key, 0) == generation:
+                self.values[key] = (value, time.monotonic())
+        return value
+
+    def fetch_positions(self, pair, timings):
+        response = timed_call(timings, 'fetch_positions', self.bybit.fetch_positions, symbols=[pair])
+        if len(response) != 2:
+            raise Exception("error getting active positions")
+        positions = {}
+        for p in response:
+            positions[p['side']] = {'size': float(p['size']), 'entry_price': float(p['entry_price']),
+                                    'leverage': float(p['leverage']) if p.get('leverage') is not None else None,
+                                    'is_isolated': p.get('is_isolated')}
+        return positions
+
+    def fetch_price(self, pair, timings):
+        symbol = self.bybit.market(pair)['id']
+        response = timed_call(timings, 'fetch_price', self.bybit.public_linear_get_recent_trading_records,
+                              {"symbol": symbol, "limit": 1})
+        return float(response['result'][0]['price'])
+
+    def fetch_balance(self, pair, timings):
+        response = timed_call(timings, 'fetch_balance', self.bybit.fetch_balance)
+        return float(response['USDT']['free'])
+
+    def get(self, kind, pair):
+        key = (kind, pair)
+        future = self.pending.pop(key, None)
+        if future is not None:
+            future.result()
+        value = self.cached(kind, pair)
+        if value is None:
+            value = self.load(kind, pair, self.timings)
+        return value
+
+    def positions(self, pair):
+        return self.get(POSITIONS, pair)
+
+    def price(self, pair):
+        return self.get(PRICE, pair)
+
+    def free_usdt(self):
+        return self.get(BALANCE, None)
+
+    def prefetch(self, pair, needs):
+        missing = [kind for kind in needs
+                   if (kind, pair if kind != BALANCE else None) not in self.pending
+                   and self.cached(kind, pair if kind != BALANCE else None) is None]
+        if len(missing) < 2:
+            return
+        for kind in missing:
+            key_pair = pair if kind != BALANCE else None
+            self.pending[(kind, key_pair)] = submit_call(self.load, kind, key_pair, self.timings)
+
+    def position(self, pair, side):
+        # Open position on one side, or None
+        p = self.positions(pair).get(side)
+        return p if p is not None and p['size'] != 0.0 else None
+
+    def set_position(self, pair, side, size, entry_price):
+        positions = self.positions(pair)
+        positions.setdefault(side, {}).update(size=size, entry_price=entry_price)
+
+    def spent_balance(self):
+        # Free margin after an order can't be derived locally, fetch it again when needed
+        self.drop(BALANCE, None)
+
+    def forget(self, pair):
+        for kind in (POSITIONS, PRICE):
+            self.drop(kind, pair)
+
+    def drop(self, kind, pair):
+        with self.lock:
+            self.generations[(kind, pair)] = self.generations.get((kind, pair), 0) + 1
+            self.values.pop((kind, pair), None)
+        future = self.pending.pop((kind, pair), None)
+        if future is not None:
+            future.cancel()
+
+
+AccountState.fetchers = {
+    POSITIONS: AccountState.fetch_positions,
+    PRICE: AccountState.fetch_price,
+    BALANCE: AccountState.fetch_balance,
+}
+
+
+class CommandContext:
+    def __init__(self, bybit, state, config, msg, max_order_time):
+        self.bybit = bybit
+        self.state = state
+        self.config = config
+        self.msg = msg
+        self.max_order_time = max_order_time
+        self.start_time = datetime.utcnow()
+        self.pair = msg.pair.upper()
+        market = bybit.market(self.pair)
+        self.symbol = market['id']
+        self.base = market['base']
+        self.settings = None
+
+    def signal_percent(self):
+        percent = self.msg.percent[:-1]
+        print(f"specific percent: {percent}")
+        return float(percent)
+
+
+def pnl_percent(position, price, direction):
+    pnl = (price - position['entry_price']) / position['entry_price'] * 100
+    return pnl if direction == 'long' else -pnl
+
+
+def entry_qty(ctx):
+    # Position size from free margin, leverage and the pair's portfolio share
+    usdt_portfolio = ctx.state.free_usdt()
+    if verbose:
+        print(f"Available USDT Portfolio Value: {usdt_portfolio}")
+    invest_precent = ctx.settings.portfolio_percent
+    if verbose:
+        print(f"Portfolio percentage: {invest_precent}%")
+    index_price = ctx.state.price(ctx.pair)
+    if verbose:
+        print(f"Price for {ctx.base}: {index_price}")
+    leverage = ctx.settings.leverage
+    position_qty = round((usdt_portfolio * leverage * (invest_precent / 100)) / index_price, 2)
+    if verbose:
+        print(f"Position qty: {position_qty}")
+    return position_qty, index_price
+
+
+def market_order(ctx, side, qty, stop_loss=None):
+    params = {"symbol": ctx.symbol,
+              "side": side,
+              "order_type": "Market",
+              "qty": qty,
+              "time_in_force": "GoodTillCancel",
+              "close_on_trigger": False,
+              "reduce_only": False}
+    if stop_loss is not None:
+        params["stop_loss"] = stop_loss
+    response = timed_call(ctx.state.timings, 'order_create', ctx.bybit.private_linear_post_order_create, params)
+    ctx.msg.order_ack_at = datetime.utcnow()
+    ctx.state.spent_balance()
+    return response
+
+
+def close_position(ctx, direction, position):
+    open_side, close_side = SIDES[direction]
+    response = timed_call(ctx.state.timings, 'order_close', ctx.bybit.create_order,
+                          ctx.pair, "Market", close_side, position['size'], params={
+                              'reduce_only': True, 'close_on_trigger': True
+                          })
+    ctx.msg.order_ack_at = datetime.utcnow()
+    if response['info']['order_status'] == "Created":
+        ctx.state.set_position(ctx.pair, open_side, 0.0, 0.0)
+        ctx.state.spent_balance()
+        log_success(ctx.msg, "Position closed successfully.")
+
+
+def own_position(ctx, direction):
+    # The position on this direction's side, refusing to act while the other side is open
+    open_side, close_side = SIDES[direction]
+    other = 'short' if direction == 'long' else 'long'
+    if ctx.state.position(ctx.pair, close_side) is not None:
+        raise Exception(f"this bot has a {other} position open.", "warn")
+    position = ctx.state.position(ctx.pair, open_side)
+    if position is None:
+        raise Exception(f"there is no active {direction} position to close.", "warn")
+    return position
+
+
+def live_margin(ctx):
+    # Leverage and margin mode as reported on the position rows, when both sides agree
+    rows = [p for p in ctx.state.positions(ctx.pair).values()
+            if p.get('leverage') is not None and p.get('is_isolated') is not None]
+    if len(rows) != 2 or len({(p['leverage'], p['is_isolated']) for p in rows}) != 1:
+        return None
+    return rows[0]['leverage'], rows[0]['is_isolated']
+
+
+def set_margin_mode(ctx, leverage, is_isolated):
+    # Only call the exchange when the confirmed state differs from the bot's settings
+    bot_id = ctx.msg.bot_id
+    cached = margin_cache.get_margin(bot_id, ctx.symbol)
+    current = live_margin(ctx) or cached
+    if current == (leverage, is_isolated):
+        if verbose:
+            print("Leverage and Cross/Isolated already at the desired values.")
+        if cached != current:
+            margin_cache.save_margin(bot_id, ctx.symbol, leverage, is_isolated)
+        return
 
-                    # Calculate Qty
-                    position_qty = round((usdt_portfolio * leverage * (invest_precent / 100)) / index_price,
-                                         2)
+    try:
+        need_leverage = current is None or current[0] != leverage
+        if current is None or current[1] != is_isolated:
+            if verbose:
+                print("Setting Cross/Isolated...")
+                print(f"is_isolated value: {is_isolated}")
+            try:
+                timed_call(ctx.state.timings, 'switch_isolated', ctx.bybit.private_linear_post_position_switch_isolated,
+                           {"symbol": ctx.symbol,
+                            "is_isolated": is_isolated,
+                            "buy_leverage": leverage,
+                            "sell_leverage": leverage})
+                # The switch applies the leverage too
+                need_leverage = False
+            except ExchangeError as e:
+                err_json = get_error_json(e)
+                if err_json['ret_code'] == 130056:
                     if verbose:
-                        print(f"Position qty: {position_qty}")
-
-                    # Check max_order_time
-                    if (datetime.utcnow() - start_time).seconds >= max_order_time:
-                        raise Exception("max_order_time expired.", "warn")
-
-                    # response = bybit.create_order(pair, "Market", "Sell", position_qty)
-
-                    # Set Stop Loss
-                    sl_price = None
-                    if f"{pair}_stop_loss" in config['trade']:
-                        sl_percent = float(config['trade'][f"{pair}_stop_loss"])
-                        sl_price = round(((100 - sl_percent) / 100) * index_price, 2)  # in long its smaller than entry
-                        if verbose:
-                            print(f"SL Price: {sl_price}")
-
-                    if sl_price is not None:
-                        response = bybit.private_linear_post_order_create({"symbol": symbol,
-                                                                           "side": "Buy",
-                                                                           "order_type": "Market",
-                                                                           "qty": position_qty,
-                                                                           "time_in_force": "GoodTillCancel",
-                                                                           "close_on_trigger": False,
-                                                                           "reduce_only": False,
-                                                                           "stop_loss": sl_price})
-                    else:
-                        response = bybit.private_linear_post_order_create({"symbol": symbol,
-                                                                           "side": "Buy",
-                                                                           "order_type": "Market",
-                                                                           "qty": position_qty,
-                                                                           "time_in_force": "GoodTillCancel",
-                                                                           "close_on_trigger": False,
-                                                                           "reduce_only": False})
-
-                    # Read Take Profit Setting
-                    tps = []
-                    tpc = 1
-                    total_percentage = 0.0
-                    while f"{pair}_tp_{tpc}_%" in config['trade']:
-                        tp_percent = float(config['trade'][f"{pair}_tp_{tpc}_%"])
-                        tp_percent_of_position = float(config['trade'][f"{pair}_tp_{tpc}_%_of_position"])
-                        total_percentage += tp_percent_of_position
-                        tps.append((tp_percent, tp_percent_of_position))
-                        tpc += 1
-
-                    if len(tps) > 0 and total_percentage != 100.0:
-                        raise Exception("sum of take profit percents should be 100.")
-
-                    for tp in tps:
-                        tp_qty = (tp[1] / 100) * position_qty
-                        tp_price = round(((100 + tp[0]) / 100) * index_price, 2)  # for long its more than entry
-                        if verbose:
-                            print("Setting Take Profit...")
-                            print(f"TP Qty : {tp_qty}   TP Price: {tp_price}")
-                        response = bybit.privateLinearPostStopOrderCreate({"symbol": symbol,
-                                                                           "side": "Sell",
-                                                                           "order_type": "Market",
-                                                                           "qty": tp_qty,
-                                                                           "base_price": index_price,
-                                                                           "stop_px": tp_price,
-                                                                           "time_in_force": "GoodTillCancel",
-                                                                           "trigger_by": "LastPrice",
-                                                                           "close_on_trigger": True,
-                                                                           "reduce_only": True
-                                                                           })
-
-                    log_success(msg, "Position opened successfully.")
-
-            elif command == "exit-short":
-                if verbose:
-                    print(f"Closing short position in {pair}")
-
-                # Check for current positions
-                response = bybit.fetch_positions(symbols=[pair])
-                have_buy_position = False
-                have_sell_position = False
-                buy_qty = None
-                sell_qty = None
-                if len(response) != 2:
-                    raise Exception("error getting active positions")
-
-                for p in response:
-                    if p['side'] == "Sell" and float(p['size']) != 0.0:
-                        have_sell_position = True
-                        sell_qty = float(p['size'])
-                    if p['side'] == "Buy" and float(p['size']) != 0.0:
-                        have_buy_position = True
-                        buy_qty = float(p['size'])
-                if have_buy_position:
-                    raise Exception("this bot has a long position open.", "warn")
-
-                elif have_sell_position:
-                    # Cancel All Conditional Orders
-                    bybit.private_linear_post_stop_order_cancel_all({"symbol": symbol})
-
-                    # Close short position
-                    response = bybit.create_order(pair, "Market", "Buy", sell_qty, params={
-                        'reduce_only': True, 'close_on_trigger': True
-                    })
-                    if response['info']['order_status'] == "Created":
-                        log_success(msg, "Position closed successfully.")
-                else:
-                    raise Exception("there is no active short position to close.", "warn")
-
-            elif command == "exit-long":
-                if verbose:
-                    print(f"Closing long position in {pair}")
-
-                # Check for current positions
-                response = bybit.fetch_positions(symbols=[pair])
-                have_buy_position = False
-                have_sell_position = False
-                buy_qty = None
-                sell_qty = None
-                if len(response) != 2:
-                    raise Exception("error getting active positions")
-
-                for p in response:
-                    if p['side'] == "Sell" and float(p['size']) != 0.0:
-                        have_sell_position = True
-                        sell_qty = float(p['size'])
-                    if p['side'] == "Buy" and float(p['size']) != 0.0:
-                        have_buy_position = True
-                        buy_qty = float(p['size'])
-                if have_sell_position:
-                    raise Exception("this bot has a short position open.", "warn")
-                elif have_buy_position:
-                    # Cancel All Conditional Orders
-                    bybit.private_linear_post_stop_order_cancel_all({"symbol": symbol})
-
-                    # Close short position
-                    response = bybit.create_order(pair, "Market", "Sell", buy_qty, params={
-                        'reduce_only': True, 'close_on_trigger': True
-                    })
-                    if response['info']['order_status'] == "Created":
-                        log_success(msg, "Position closed successfully.")
+                        print("Cross/Isolated already at the desired value.")
                 else:
-                    raise Exception("there is no active long position to close.", "warn")
-            
-            elif command == "take-profit-long-1":
-                if verbose:
-                    print(f"take profit long1 in {pair}")
-                response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-                p_cur_price = float(response['result'][0]['price'])
-                # Check for current positions
-                response = bybit.fetch_positions(symbols=[pair])
-                have_buy_position = False
-                have_sell_position = False
-                buy_qty = None
-                sell_qty = None
-                if len(response) != 2:
-                    raise Exception("error getting active positions")
-                p_entry = 0
-                for p in response:
-                    if p['side'] == "Sell" and float(p['size']) != 0.0:
-                        have_sell_position = True
-                        sell_qty = float(p['size'])
-                    if p['side'] == "Buy" and float(p['size']) != 0.0:
-                        p_entry = float(p['entry_price'])
-                        have_buy_position = True
-                        buy_qty = float(p['size'])
-                if have_sell_position:
-                    raise Exception("this bot has a short position open.", "warn")
-                elif have_buy_position:
-                    pnl_percent = ((p_cur_price - p_entry)/p_entry)*100
-                    if pnl_percent>0:
-                        # Close short position
-                        response = bybit.create_order(pair, "Market", "Sell", buy_qty, params={
-                            'reduce_only': True, 'close_on_trigger': True
-                        })
-                        if response['info']['order_status'] == "Created":
-                            log_success(msg, "Position closed successfully.")
-                    else:
-                        log_error(msg, "profit is not positive", "warn")
-                else:
-                    raise Exception("there is no active long position to close.", "warn")
-            elif command == "take-profit-short-1":
-                if verbose:
-                    print(f"take profit short1 in {pair}")
-                response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-                p_cur_price = float(response['result'][0]['price'])
-                # Check for current positions
-                response = bybit.fetch_positions(symbols=[pair])
-                have_buy_position = False
-                have_sell_position = False
-                buy_qty = None
-                sell_qty = None
-                if len(response) != 2:
-                    raise Exception("error getting active positions")
-                p_entry = 0
-                for p in response:
-                    if p['side'] == "Sell" and float(p['size']) != 0.0:
-                        have_sell_position = True
-                        sell_qty = float(p['size'])
-                        p_entry = float(p['entry_price'])
-                    if p['side'] == "Buy" and float(p['size']) != 0.0:
-                        have_buy_position = True
-                        buy_qty = float(p['size'])
-                if have_buy_position:
-                    raise Exception("this bot has a long position open.", "warn")
-
-                elif have_sell_position:
-                    pnl_percent = -((p_cur_price - p_entry)/p_entry)*100
-                    print(f"PNL percent: {pnl_percent}")
-                    if pnl_percent>0:
-                        # Close short position
-                        response = bybit.create_order(pair, "Market", "Buy", sell_qty, params={
-                            'reduce_only': True, 'close_on_trigger': True
-                        })
-                        if response['info']['order_status'] == "Created":
-                            log_success(msg, "Position closed successfully.")
-                    else:
-                        log_error(msg, "profit is not positive", "warn")
-                else:
-                    raise Exception("there is no active short position to close.", "warn")
-
-            elif command == "take-profit-long-2":
-                if verbose:
-                    print(f"take profit long2 in {pair}")
-                percent = msg.percent
-                percent = percent[:-1]
-                print(f"specific percent: {percent}")
-                percent = float(percent)
-
-                response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-                p_cur_price = float(response['result'][0]['price'])
-                # Check for current positions
-                response = bybit.fetch_positions(symbols=[pair])
-                have_buy_position = False
-                have_sell_position = False
-                buy_qty = None
-                sell_qty = None
-                if len(response) != 2:
-                    raise Exception("error getting active positions")
-                p_entry = 0
-                for p in response:
-                    if p['side'] == "Sell" and float(p['size']) != 0.0:
-                        have_sell_position = True
-                        sell_qty = float(p['size'])
-                    if p['side'] == "Buy" and float(p['size']) != 0.0:
-                        have_buy_position = True
-                        buy_qty = float(p['size'])
-                        p_entry = float(p['entry_price'])
-                if have_sell_position:
-                    raise Exception("this bot has a short position open.", "warn")
-                elif have_buy_position:
-                    print("p_cur_price=", p_cur_price)
-                    print("p_entry=", p_entry)
-                    pnl_percent = ((p_cur_price - p_entry)/p_entry)*100
-                    print("pnl_percent=", pnl_percent)
-                    if pnl_percent >= percent:
-                        # Close position
-                        response = bybit.create_order(pair, "Market", "Sell", buy_qty, params={
-                            'reduce_only': True, 'close_on_trigger': True
-                        })
-                        if response['info']['order_status'] == "Created":
-                            log_success(msg, "Position closed successfully.")
-                    else:
-                        log_error(msg, "P/L is less than specified percent.", "warn")
-                else:
-                    raise Exception("there is no active long position to close.", "warn")
-            
-            elif command == "take-profit-short-2":
-                if verbose:
-                    print(f"take profit short in {pair}")
-                percent = msg.percent
-                percent = percent[:-1]
-                print(f"specific percent: {percent}")
-                percent = float(percent)
-                print("percent=", percent)
-                response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-                p_cur_price = float(response['result'][0]['price'])
-                # Check for current positions
-                response = bybit.fetch_positions(symbols=[pair])
-                have_buy_position = False
-                have_sell_position = False
-                buy_qty = None
-                sell_qty = None
-                if len(response) != 2:
-                    raise Exception("error getting active positions")
-                p_entry = 0.0
-                for p in response:
-                    if p['side'] == "Sell" and float(p['size']) != 0.0:
-                        have_sell_position = True
-                        sell_qty = float(p['size'])
-                        p_entry = float(p['entry_price'])
-                    if p['side'] == "Buy" and float(p['size']) != 0.0:
-                        have_buy_position = True
-                        buy_qty = float(p['size'])
-                if have_buy_position:
-                    raise Exception("this bot has a long position open.", "warn")
-                elif have_sell_position:
-                    pnl_percent = ((p_cur_price - p_entry)/p_entry)*100
-                    print("pnl_percent=", pnl_percent)
-                    if pnl_percent >= percent:
-                        # Close short position
-                        response = bybit.create_order(pair, "Market", "Buy", sell_qty, params={
-                            'reduce_only': True, 'close_on_trigger': True
-                        })
-                        if response['info']['order_status'] == "Created":
-                            log_success(msg, "Position closed successfully.")
-                    else:
-                        log_error(msg, "P/L is less than specified percent.", "warn")
-                else:
-                    raise Exception("there is no active short position to close.", "warn")
-
-            elif command == "take-profit-long-3":
-                if verbose:
-                    print(f"take profit long3 in {pair}")
-                percent = msg.percent
-                percent = percent[:-1]
-                print(f"specific percent: {percent}")
-                percent = float(percent)
-                has_p, p_type, p_qty, p_sl, p_upnl, p_entry, p_cur_price, side = get_position(bybit, bot_id, pair)
-                if has_p:
-                    if p_type == 'no':
-                        log_error(msg, "there is no active long position to close.", "warn")
-                    elif p_type == 'long':
-                        pnl_percent = ((p_cur_price - p_entry)/p_entry)*100
-                        print(f"PNL percent: {pnl_percent}")
-                        print(f"signal percent: {percent}")
-                        if pnl_percent >= percent:
-                            response = bybit.create_order(pair, "Market", side, p_qty, params={
-                                    'reduce_only': True, 'close_on_trigger': True
-                                })
-                            if response['info']['order_status'] == "Created":
-                                log_success(msg, "Position closed successfully.")
-                        else:
-                            # Get Portfolio Value
-                            if verbose:
-                                print("Getting portfolio...")
-                            response = bybit.fetch_balance()
-                            usdt_portfolio = float(response['USDT']['free'])
-                            if verbose:
-                                print(f"Available USDT Portfolio Value: {usdt_portfolio}")
-                            invest_precent = float(config['trade'][f"{pair}_portfolio_percent"])
-                            if verbose:
-                                print(f"Portfolio percentage: {invest_precent}%")
-
-                            # Get Latest price for symbol
-                            response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-                            index_price = float(response['result'][0]['price'])
-                            if verbose:
-                                print(f"Price for {base}: {index_price}")
-                            leverage = float(config['trade'][f"{pair}_leverage_multiple"])
-                            # Calculate Qty
-                            position_qty = round((usdt_portfolio * leverage * (invest_precent / 100)) / index_price, 2)
-                            if verbose:
-                                print(f"Position qty: {position_qty}")
-                            
-                            tp_params = {'stopPrice': index_price}
-                            # # order = bybit.create_order(symbol, 'TAKE_PROFIT_MARKET', "Sell", position_qty, None, tp_params)
-                            # order = bybit.create_order(symbol=symbol, type="TAKE_PROFIT_MARKET", side="Sell", amount=position_qty, price=index_price , params={"base_price": index_price,  "stop_px": index_price, "closePosition": True, "stopPrice": index_price})
-                            response = bybit.private_linear_post_order_create({"symbol": symbol,
-                                                                           "side": "Sell",
-                                                                           "order_type": "Market",
-                                                                           "qty": position_qty,
-                                                                           "time_in_force": "GoodTillCancel",
-                                                                           "close_on_trigger": False,
-                                                                           "reduce_only": False})
-                            log_success(msg, "take-profit order created")
-                    elif p_type == 'short':
-                        log_error(msg, "there is no active long position to close.", "warn")
-                else:
-                    log_error(msg, "there is no active long position to close.", "warn")
-            
-            elif command == "take-profit-short-3":
-                if verbose:
-                    print(f"take profit short3 in {pair}")
-                percent = msg.percent
-                percent = percent[:-1]
-                print(f"specific percent: {percent}")
-                percent = float(percent)
-                has_p, p_type, p_qty, p_sl, p_upnl, p_entry, p_cur_price, side = get_position(bybit, bot_id, pair)
-                if has_p:
-                    if p_type == 'no':
-                        log_error(msg, "there is no active short position to close.", "warn")
-                    elif p_type == 'short':
-                        pnl_percent = -((p_cur_price - p_entry)/p_entry)*100
-                        print(f"PNL percent: {pnl_percent}")
-                        print(f"signal percent: {percent}")
-                        if pnl_percent >= percent:
-                            response = bybit.create_order(pair, "Market", side, p_qty, params={
-                                    'reduce_only': True, 'close_on_trigger': True
-                                })
-                            if response['info']['order_status'] == "Created":
-                                log_success(msg, "Position closed successfully.")
-                        else:
-                            # Get Portfolio Value
-                            if verbose:
-                                print("Getting portfolio...")
-                            response = bybit.fetch_balance()
-                            usdt_portfolio = float(response['USDT']['free'])
-                            if verbose:
-                                print(f"Available USDT Portfolio Value: {usdt_portfolio}")
-                            invest_precent = float(config['trade'][f"{pair}_portfolio_percent"])
-                            if verbose:
-                                print(f"Portfolio percentage: {invest_precent}%")
-
-                            # Get Latest price for symbol
-                            response = bybit.public_linear_get_recent_trading_records({"symbol": symbol, "limit": 1})
-                            index_price = float(response['result'][0]['price'])
-                            if verbose:
-                                print(f"Price for {base}: {index_price}")
-                            leverage = float(config['trade'][f"{pair}_leverage_multiple"])
-                            # Calculate Qty
-                            position_qty = round((usdt_portfolio * leverage * (invest_precent / 100)) / index_price, 2)
-                            if verbose:
-                                print(f"Position qty: {position_qty}")
-                            tp_params = {'stopPrice': index_price}
-                            # order = bybit.create_order(symbol, 'TAKE_PROFIT_MARKET', "Buy", position_qty, None, tp_params)
-                            # order = bybit.create_order(symbol=symbol, type="TAKE_PROFIT_MARKET", side="Buy", amount=position_qty, price=index_price , params={"base_price":index_price,  "stop_px":index_price, "closePosition": True, "stopPrice": index_price})
-                            response = bybit.private_linear_post_order_create({"symbol": symbol,
-                                                                           "side": "Buy",
-                                                                           "order_type": "Market",
-                                                                           "qty": position_qty,
-                                                                           "time_in_force": "GoodTillCancel",
-                                                                           "close_on_trigger": False,
-                                                                           "reduce_only": False})
-
-                            log_success(msg, "take-profit order created")
-                    elif p_type == 'long':
-                        log_error(msg, "there is no active short position to close.", "warn")
+                    raise Exception("error setting Cross/Isolated.")
+
+        if need_leverage:
+            if verbose:
+                print(f"Leverage value: {leverage}")
+                print(f"Setting leverage...")
+            try:
+                timed_call(ctx.state.timings, 'set_leverage', ctx.bybit.private_linear_post_position_set_leverage,
+                           {"symbol": ctx.symbol,
+                            "buy_leverage": leverage,
+                            "sell_leverage": leverage})
+            except ExchangeError as e:
+                err_json = get_error_json(e)
+                if err_json['ret_code'] == 34036:
+                    if verbose:
+                        print("Leverage already at the desired value.")
                 else:
-                    log_error(msg, "there is no active short position to close.", "warn")
-            else:
-                raise Exception(f"invalid command {command}", "warn")
+                    raise Exception("error setting leverage.")
+    except Exception:
+        # Whatever the exchange holds now is unknown
+        margin_cache.forget_margin(bot_id, ctx.symbol)
+        raise
+    margin_cache.save_margin(bot_id, ctx.symbol, leverage, is_isolated)
+
+
+def enter_position(ctx, direction):
+    open_side, close_side = SIDES[direction]
+    if verbose:
+        print(f"Entering {direction} position in {ctx.pair}")
 
-        except Exception as e:
-            severity = "high"
-            if len(e.args) >= 2:
-                severity = e.args[1]
-            log_error(msg, str(e.args[0]), severity)
+    # Check for current positions
+    if ctx.state.position(ctx.pair, "Buy") is not None or ctx.state.position(ctx.pair, "Sell") is not None:
+        raise Exception("this bot already has a position open.", "warn")
 
-    release_lock(bot_id)
+    settings = ctx.settings
+    set_margin_mode(ctx, settings.leverage, settings.is_isolated)
+
+    # Stop loss sits below the entry for a long and above it for a short
+    sign = -1 if direction == 'long' else 1
+
+    # Pairs running side by side size their entries off the free balance one at a time
+    with ctx.state.sizing_lock:
+        if verbose:
+            print("Getting portfolio...")
+        position_qty, index_price = entry_qty(ctx)
+
+        # Check max_order_time
+        if (datetime.utcnow() - ctx.start_time).seconds >= ctx.max_order_time:
+            raise Exception("max_order_time expired.", "warn")
+
+        sl_price = None
+        if settings.stop_loss is not None:
+            sl_price = round(((100 + sign * settings.stop_loss) / 100) * index_price, 2)
+            if verbose:
+                print(f"SL Price: {sl_price}")
+
+        market_order(ctx, open_side, position_qty, sl_price)
+    ctx.state.set_position(ctx.pair, open_side, position_qty, index_price)
+
+    # Take profits sit on the other side of the entry from the stop loss
+    rungs = []
+    for tp in settings.take_profits:
+        tp_qty = (tp.percent_of_position / 100) * position_qty
+        tp_price = round(((100 - sign * tp.percent) / 100) * index_price, 2)
+        if verbose:
+            print(f"TP Qty : {tp_qty}   TP Price: {tp_price}")
+        rungs.append({'rung': len(rungs) + 1, 'qty': tp_qty, 'price': tp_price})
+    if rungs and verbose:
+        print(f"Setting {len(rungs)} Take Profits...")
+    place_take_profits(ctx, close_side, index_price, rungs)
+
+    failed = [r for r in rungs if r['status'] != "placed"]
+    if failed:
+        raise Exception(f"position opened but {len(failed)} of {len(rungs)} take profit orders failed: "
+                        + "; ".join(f"rung {r['rung']}: {r['error']}" for r in failed))
+    log_success(ctx.msg, "Position opened successfully.")
+
+
+def place_take_profit(ctx, side, base_price, rung):
+    try:
+        response = timed_call(ctx.state.timings, f"tp_order_create_{rung['rung']}",
+                              ctx.bybit.privateLinearPostStopOrderCreate,
+                              {"symbol": ctx.symbol,
+                               "side": side,
+                               "order_type": "Market",
+                               "qty": rung['qty'],
+                               "base_price": base_price,
+                               "stop_px": rung['price'],
+                               "time_in_force": "GoodTillCancel",
+                               "trigger_by": "LastPrice",
+                               "close_on_trigger": True,
+                               "reduce_only": True
+                               })
+        rung['status'] = "placed"
+        rung['order_id'] = (response.get('result') or {}).get('stop_order_id')
+    except Exception as e:
+        rung['status'] = "failed"
+        rung['error'] = str(e)
+
+
+def place_take_profits(ctx, side, base_price, rungs):
+    # The v2 linear API has no batch endpoint for conditional orders, so all rungs
+    # go out at once on the shared call threads; results are kept per rung
+    futures = [submit_call(place_take_profit, ctx, side, base_price, rung) for rung in rungs]
+    for future in futures:
+        future.result()
+    ctx.msg.tp_orders = rungs
+
+
+def exit_position(ctx, direction):
+    if verbose:
+        print(f"Closing {direction} position in {ctx.pair}")
+    position = own_position(ctx, direction)
+    # Cancel All Conditional Orders
+    timed_call(ctx.state.timings, 'cancel_all', ctx.bybit.private_linear_post_stop_order_cancel_all,
+               {"symbol": ctx.symbol})
+    close_position(ctx, direction, position)
+
+
+def take_profit_if_positive(ctx, direction):
+    if verbose:
+        print(f"take profit {direction}1 in {ctx.pair}")
+    position = own_position(ctx, direction)
+    pnl = pnl_percent(position, ctx.state.price(ctx.pair), direction)
+    print(f"PNL percent: {pnl}")
+    if pnl > 0:
+        close_position(ctx, direction, position)
+    else:
+        log_error(ctx.msg, "profit is not positive", "warn")
+
+
+def take_profit_at_percent(ctx, direction):
+    if verbose:
+        print(f"take profit {direction}2 in {ctx.pair}")
+    percent = ctx.signal_percent()
+    position = own_position(ctx, direction)
+    pnl = pnl_percent(position, ctx.state.price(ctx.pair), direction)
+    print(f"PNL percent: {pnl}")
+    if pnl >= percent:
+        close_position(ctx, direction, position)
+    else:
+        log_error(ctx.msg, "P/L is less than specified percent.", "warn")
+
+
+def take_profit_or_hedge(ctx, direction):
+    # Close at the signal's P/L, otherwise open an opposite market order sized like an entry
+    if verbose:
+        print(f"take profit {direction}3 in {ctx.pair}")
+    percent = ctx.signal_percent()
+    open_side, close_side = SIDES[direction]
+    position = ctx.state.position(ctx.pair, open_side)
+    if position is None or ctx.state.position(ctx.pair, close_side) is not None:
+        log_error(ctx.msg, f"there is no active {direction} position to close.", "warn")
+        return
+    pnl = pnl_percent(position, ctx.state.price(ctx.pair), direction)
+    print(f"PNL percent: {pnl}")
+    print(f"signal percent: {percent}")
+    if pnl >= percent:
+        close_position(ctx, direction, position)
+        return
+
+    if verbose:
+        print("Getting portfolio...")
+    with ctx.state.sizing_lock:
+        position_qty, index_price = entry_qty(ctx)
+        market_order(ctx, close_side, position_qty)
+    ctx.state.set_position(ctx.pair, close_side, position_qty, index_price)
+    log_success(ctx.msg, "take-profit order created")
+
+
+# command -> (handler, account state it reads, handler arguments)
+COMMANDS = {}
+
+
+def register(command, handler, needs, **kwargs):
+    COMMANDS[command] = (handler, needs, kwargs)
+
+
+for direction in SIDES:
+    register(f"enter-{direction}", enter_position, (SETTINGS, POSITIONS, BALANCE, PRICE), direction=direction)
+    register(f"exit-{direction}", exit_position, (POSITIONS,), direction=direction)
+    register(f"take-profit-{direction}-1", take_profit_if_positive, (POSITIONS, PRICE), direction=direction)
+    register(f"take-profit-{direction}-2", take_profit_at_percent, (POSITIONS, PRICE), direction=direction)
+    register(f"take-profit-{direction}-3", take_profit_or_hedge, (SETTINGS, POSITIONS, PRICE, BALANCE),
+             direction=direction)
+
+
+def process_message(bybit, state, config, msg, max_webhook_message_age_time, max_order_time):
+    command = msg.command.lower()
+    print(f"command={command}")
+
+    try:
+        # Check message expire
+        if (datetime.utcnow() - msg.timestamp).seconds >= max_webhook_message_age_time:
+            raise Exception(f"max_webhook_message_age_time expired for message. ({max_webhook_message_age_time}s)",
+                            "warn")
+
+        if command not in COMMANDS:
+            raise Exception(f"invalid command {command}", "warn")
+        handler, needs, kwargs = COMMANDS[command]
+
+        msg.exchange_first_call_at = datetime.utcnow()
+        if current_timer is not None:
+            current_timer.begin(bot_id=msg.bot_id, message_id=str(msg.id), command=command, pair=msg.pair)
+        state.begin(msg)
+        ctx = CommandContext(bybit, state, config, msg, max_order_time)
+        if SETTINGS in needs:
+            # Validated when the bot's ini was loaded; a rejected pair fails before any exchange call
+            ctx.settings = config.pair(ctx.pair)
+        # Independent reads run in parallel, the handler waits only for what it touches
+        state.prefetch(ctx.pair, [kind for kind in needs if kind != SETTINGS])
+        handler(ctx, **kwargs)
+
+    except Exception as e:
+        severity = "high"
+        if len(e.args) >= 2:
+            severity = e.args[1]
+        if severity != "warn":
+            # After an exchange failure the cached state may not match the account any more
+            state.forget(msg.pair.upper())
+            state.spent_balance()
+        log_error(msg, str(e.args[0]), severity)
+
+
+def coalesce_messages(objs):
+    # Cancel pending messages that a later pending message makes pointless
+    master_config = ConfigParser()
+    master_config.read("master_settings.ini")
+    kept, cancelled = CoalesceRules(master_config).plan(objs)
+    by_superseder = {}
+    for earlier, later in cancelled:
+        by_superseder.setdefault(later.id, (later, []))[1].append(earlier.id)
+    for later, ids in by_superseder.values():
+        Message.objects(id__in=ids, status="pending").update(
+            set__status="cancelled", set__error_msg=f"superseded by {later.command} at {later.timestamp}")
+    if cancelled and verbose:
+        cprint(f"Cancelled {len(cancelled)} superseded messages.", BColors.WARNING)
+    return kept
+
+
+def run_bot(bot_id, bybit=None, lock_owner=None, worker_started_at=None):
+    # Process every pending message of a bot. Returns the exchange client so a
+    # warm worker can reuse it (and its loaded markets) for the next dispatch.
+    if worker_started_at is None:
+        worker_started_at = datetime.utcnow()
+    heartbeat = None
+    if lock_owner is not None:
+        heartbeat = LockHeartbeat(bot_id, lock_owner).start()
+    try:
+        return process_bot(bot_id, bybit, worker_started_at)
+    finally:
+        if heartbeat is not None:
+            heartbeat.stop()
+        release_lock(bot_id, lock_owner)
+
+
+def process_bot(bot_id, bybit, worker_started_at):
+    # Entries of one webhook batch share a timestamp; their ids, assigned in batch order, break the tie
+    objs = Message.objects(bot_id=bot_id, status="pending").order_by('+timestamp', '+id')
+    try:
+        config = bot_configs.get(bot_id)
+    except BotConfigError as e:
+        # Nothing can run until the file is fixed; don't leave the messages to be dispatched again
+        cprint(str(e), BColors.FAIL)
+        for msg in objs:
+            log_error(msg, str(e), "high")
+        return bybit
+
+    if bybit is None:
+        bybit = make_client(bot_id)
+        if bybit is None:
+            return None
+
+    objs = coalesce_messages(objs)
+    if len(objs) == 0:
+        if verbose:
+            print("There are no messages to process. exiting...")
+        return bybit
+
+    global current_timer
+    current_timer = getattr(bybit, 'call_timer', None)
+    if verbose:
+        print(f"Loading market data...")
+    if current_timer is not None:
+        current_timer.begin(bot_id=bot_id, stage="load_markets")
+    markets = markets_cache.load_markets(bybit)
+    if current_timer is not None:
+        current_timer.end()
+    # Positions and prices fetched for one message are reused by the next ones for this long
+    state = AccountState(bybit, config.state_max_age)
+
+    for msg in objs:
+        msg.worker_started_at = worker_started_at
+    chains = {}
+    for msg in objs:
+        chains.setdefault(msg.pair.upper(), []).append(msg)
+
+    def run_chain(chain):
+        # Messages of one pair always run in order
+        for msg in chain:
+            if verbose:
+                print("---------------------------")
+                print(f"Processing {msg.command} for {msg.pair}, queued at {msg.timestamp}")
+            process_message(bybit, state, config, msg, config.max_webhook_message_age_time, config.max_order_time)
+
+    if pair_mode != 'concurrent' or len(chains) == 1:
+        for chain in chains.values():
+            run_chain(chain)
+    else:
+        # Different pairs run side by side on the one client and its HTTP session
+        global pair_pool
+        if pair_pool is None:
+            pair_pool = ThreadPoolExecutor(max_workers=max_pairs, thread_name_prefix="pair")
+        futures = [pair_pool.submit(contextvars.copy_context().run, run_chain, chain) for chain in chains.values()]
+        for future in futures:
+            future.result()
+
+    return bybit
+
+
+if __name__ == '__main__':
+    bot_id = sys.argv[1]
+
+    verbose = True
+    if "-silent" in sys.argv[2:]:
+        verbose = False
+    verbose = True
+
+    # Lease owner handed over by the queue service
+    lock_owner = None
+    for arg in sys.argv[2:]:
+        if arg.startswith("-lock="):
+            lock_owner = arg[len("-lock="):]
+
+    if verbose:
+        cprint(f"BotID: {bot_id}", BColors.OKBLUE)
+
+    # Connect to DB
+    connect('trade_db')
+    if verbose:
+        print("Message database connected!")
+
+    if run_bot(bot_id, lock_owner=lock_owner, worker_started_at=started_at) is None:
+        sys.exit(-1)
     print("")
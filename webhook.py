@@ -1,8 +1,16 @@
 from datetime import datetime
-from flask import Flask, request, abort
+from uuid import uuid4
+from configparser import ConfigParser
+from flask import Flask, Response, request, abort
 from flask_mongoengine import MongoEngine
 from mongoengine import *
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from waitress import serve
+from ingest_buffer import IngestBuffer
+import metrics
+import commands
+from dedupe import TTLCache, time_bucket
 
 app = Flask(__name__)
 
@@ -24,6 +32,82 @@ class Message(Document):
     timestamp = DateTimeField(default=datetime.utcnow)
     status = StringField(default="pending")
     error_msg = StringField()
+    error_severity = StringField()
+    group_id = StringField()
+    dedupe_key = StringField()
+    dispatched_at = DateTimeField()
+    worker_started_at = DateTimeField()
+    exchange_first_call_at = DateTimeField()
+    order_ack_at = DateTimeField()
+    finished_at = DateTimeField()
+    timings = DictField()
+    tp_orders = ListField(DictField())
+    call_summary = DictField()
+
+    meta = {
+        'indexes': [('status', 'bot_id', 'timestamp')],
+        'auto_create_index': False,
+    }
+
+
+class Signal(Document):
+    # Capped collection tailed by the queue service to wake up on new work
+    bot_ids = ListField(StringField())
+    timestamp = DateTimeField(default=datetime.utcnow)
+    meta = {'max_documents': 10000, 'max_size': 4 * 1024 * 1024}
+
+
+# Metrics
+requests_total = metrics.Counter('webhook_requests_total', "Webhook requests by outcome.", labels=('outcome',))
+requests_in_flight = metrics.Gauge('webhook_requests_in_flight', "Webhook requests currently being handled.")
+parse_seconds = metrics.Histogram('webhook_parse_seconds', "Time spent parsing a webhook command.",
+                                  buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005))
+mongo_write_seconds = metrics.Histogram('webhook_mongo_write_seconds', "Time spent on one bulk insert to mongo.")
+fanout_size = metrics.Histogram('webhook_fanout_size', "Number of bots addressed by one alert.",
+                                buckets=(1, 2, 5, 10, 20, 50, 100))
+dedupe_hits = metrics.Counter('webhook_dedupe_hits_total', "Duplicate alerts dropped, by layer.", labels=('layer',))
+dedupe_misses = metrics.Counter('webhook_dedupe_misses_total', "Alerts that passed the dedupe cache.")
+
+
+def write_messages(records):
+    # Unordered insert so a duplicate (dedupe_key index, or _id of a retried batch) does not stop the rest
+    with mongo_write_seconds.time():
+        try:
+            Message._get_collection().insert_many([r.to_mongo() for r in records], ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(err['code'] != 11000 for err in errors):
+                raise
+            print(f"Dropped {len(errors)} duplicate messages.")
+            dedupe_hits.inc('mongo', amount=len(errors))
+    # Wake up the queue service. The messages are stored by now, so a failed signal only
+    # delays them until the queue service sweeps; failing the request would get them re-sent
+    try:
+        Signal(bot_ids=sorted({r.bot_id for r in records})).save()
+    except Exception as e:
+        print(f"Couldn't signal the queue service: {e}")
+
+
+# Read webhook settings
+webhook_config = ConfigParser()
+webhook_config.read("webhook_settings.ini")
+
+ingest_buffer = None
+if webhook_config.get('ingest', 'mode', fallback='sync') == 'buffered':
+    ingest_buffer = IngestBuffer(write_messages,
+                                 max_size=webhook_config.getint('ingest', 'buffer_size', fallback=10000),
+                                 batch_size=webhook_config.getint('ingest', 'flush_batch_size', fallback=200),
+                                 flush_interval=webhook_config.getint('ingest', 'flush_interval_ms',
+                                                                      fallback=20) / 1000,
+                                 max_attempts=webhook_config.getint('ingest', 'flush_max_attempts', fallback=5))
+
+dedupe_cache = None
+dedupe_window = webhook_config.getint('dedupe', 'window_seconds', fallback=30)
+if webhook_config.getboolean('dedupe', 'enabled', fallback=False):
+    dedupe_cache = TTLCache(webhook_config.getint('dedupe', 'ttl_seconds', fallback=120))
+
+buffer_depth = metrics.Gauge('webhook_ingest_buffer_depth', "Alerts waiting in the ingest buffer.",
+                             func=lambda: ingest_buffer.queue.qsize() if ingest_buffer is not None else 0)
 
 
 @app.route('/')
@@ -31,34 +115,169 @@ def test():
     return 'webhook server is online!'
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     if request.method == 'POST':
-        command = request.form.get('command')
-        command = command.encode('UTF-8')
-        # print(f"new message : {request.data.decode('UTF-8')}")
-        print(f"new message : {command.decode('UTF-8')}")
+        requests_in_flight.inc()
         try:
+            return handle_command(request.form.get('command'))
+        finally:
+            requests_in_flight.dec()
+    else:
+        requests_total.inc('bad_request')
+        abort(400)
+
+
+@app.route('/webhook/batch', methods=['POST'])
+def webhook_batch():
+    requests_in_flight.inc()
+    try:
+        return handle_batch()
+    finally:
+        requests_in_flight.dec()
+
+
+def parse_command(text):
+    # botids_pair_command[_percent], bot ids joined with '&'
+    msg = text.split("_")
+    botids = msg[0].split("&")
+    pair = msg[1]
+    command = msg[2]
+    percent = msg[3] if len(msg) > 3 else "none"
+    if not all(botids) or not pair or not command:
+        raise ValueError(f"empty field in {text!r}")
+    if command.lower() not in commands.NAMES:
+        raise ValueError(f"unknown command {command!r}")
+    return msg[0], botids, pair, command, percent
+
+
+def parse_batch_item(item):
+    if isinstance(item, str):
+        return parse_command(item.strip())
+    if isinstance(item, dict):
+        botids = item['bot_ids']
+        if isinstance(botids, list):
+            botids = "&".join(str(b) for b in botids)
+        parts = [str(botids), item['pair'], item['command']]
+        percent = item.get('percent')
+        if percent is not None:
+            # trade.py expects the percent with its trailing '%'
+            parts.append(f"{percent}%" if isinstance(percent, (int, float)) else str(percent))
+        return parse_command("_".join(parts))
+    raise ValueError(f"unsupported entry {item!r}")
+
+
+def accept_entries(entries):
+    # Dedupe, fan out and write every parsed entry with one group id, one timestamp and one insert
+    group_id = uuid4().hex
+    timestamp = datetime.utcnow()
+    records = []
+    seen = []
+    duplicates = 0
+    bucket = time_bucket(dedupe_window) if dedupe_cache is not None else None
+    for key, botids, pair, command, percent in entries:
+        fanout_size.observe(len(botids))
+
+        # Drop alerts re-sent by TradingView before they reach mongo
+        if dedupe_cache is not None:
+            dedupe_key = (key, pair, command, percent, bucket)
+            if not dedupe_cache.add(dedupe_key):
+                dedupe_hits.inc('memory')
+                duplicates += 1
+                continue
+            seen.append(dedupe_key)
+            dedupe_misses.inc()
+
+        # Ids are fixed here so a retried insert hits duplicate keys instead of queueing a trade twice
+        records += [Message(id=ObjectId(), bot_id=botid, pair=pair, command=command, percent=percent,
+                            timestamp=timestamp, group_id=group_id,
+                            dedupe_key=f"{botid}_{pair}_{command}_{percent}_{bucket}" if bucket is not None else None)
+                    for botid in botids]
+
+    try:
+        if records and (ingest_buffer is None or not ingest_buffer.put(records)):
+            write_messages(records)
+    except Exception:
+        # write_messages only raises when the insert failed, so nothing was stored and the
+        # alert TradingView re-sends must not be taken for a duplicate
+        for dedupe_key in seen:
+            dedupe_cache.discard(dedupe_key)
+        raise
+    return records, duplicates
+
+
+def handle_command(command):
+    if not isinstance(command, str):
+        print("Message without a command.")
+        requests_total.inc('bad_request')
+        abort(400)
+    command = command.encode('UTF-8')
+    # print(f"new message : {request.data.decode('UTF-8')}")
+    print(f"new message : {command.decode('UTF-8')}")
+    try:
+        with parse_seconds.time():
             # msg = request.data.decode('UTF-8').split("_")
-            msg = command.decode('UTF-8').split("_")
-            botids = msg[0].split("&")
-            pair = msg[1]
-            command = msg[2]
-            try:
-                percent = msg[3]
-                for botid in botids:
-                    record = Message(bot_id=botid, pair=pair, command=command, percent=percent).save()
-            except:
-                for botid in botids:
-                    record = Message(bot_id=botid, pair=pair, command=command).save()
-            return 'success', 200
-
-        except IndexError:
-            print("Illegal message.")
-            abort(400)
+            entry = parse_command(command.decode('UTF-8'))
 
-    else:
+        records, duplicates = accept_entries([entry])
+        if duplicates:
+            print("Duplicate message dropped.")
+            requests_total.inc('duplicate')
+            return 'duplicate', 200
+        requests_total.inc('success')
+        return 'success', 200
+
+    except (IndexError, ValueError):
+        print("Illegal message.")
+        requests_total.inc('bad_request')
         abort(400)
 
 
-serve(app, host='0.0.0.0', port=80, threads=10)
+def handle_batch():
+    # JSON array of commands (strings or objects) or newline-delimited commands
+    if request.is_json:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            requests_total.inc('bad_request')
+            return {'errors': ["body must be a JSON array"]}, 400
+    else:
+        items = [line for line in request.get_data(as_text=True).splitlines() if line.strip()]
+    print(f"new batch : {len(items)} commands")
+
+    # Validate the whole payload before anything is written
+    entries = []
+    errors = []
+    with parse_seconds.time():
+        for i, item in enumerate(items):
+            try:
+                entries.append(parse_batch_item(item))
+            except (IndexError, KeyError, TypeError, ValueError) as e:
+                errors.append(f"entry {i}: {e!r}")
+    if errors or not entries:
+        print("Illegal batch.")
+        requests_total.inc('bad_request')
+        return {'errors': errors or ["empty batch"]}, 400
+
+    records, duplicates = accept_entries(entries)
+    requests_total.inc('success')
+    return {'commands': len(entries), 'messages': len(records), 'duplicates': duplicates}, 200
+
+
+if __name__ == '__main__':
+    print("Ensuring message indexes...")
+    Message.ensure_indexes()
+    if webhook_config.getboolean('dedupe', 'mongo_index', fallback=False):
+        print("Ensuring unique dedupe index...")
+        Message._get_collection().create_index('dedupe_key', unique=True, sparse=True)
+    if ingest_buffer is not None:
+        print("Buffered ingestion enabled.")
+        ingest_buffer.start()
+    serve(app, host='0.0.0.0', port=80, threads=10)
+    if ingest_buffer is not None:
+        print("Flushing buffered messages...")
+        ingest_buffer.stop()
@@ -0,0 +1,125 @@
+import signal
+import multiprocessing
+from multiprocessing.connection import wait
+from threading import Lock
+
+
+def worker_main(conn, max_jobs):
+    # Runs inside a worker process. trade.py and ccxt are imported once
+    # and every bot keeps its authenticated client with markets already loaded.
+    from mongoengine import connect
+    import trade
+
+    # Ctrl+C reaches the whole console; the queue service stops workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    connect('trade_db')
+    clients = {}
+    jobs = 0
+    while jobs < max_jobs:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        bot_id, owner = job
+        try:
+            clients[bot_id] = trade.run_bot(bot_id, clients.get(bot_id), owner)
+        except Exception as e:
+            print(f"Worker error on bot {bot_id}: {e}")
+            clients.pop(bot_id, None)
+        jobs += 1
+        # Tell the pool whether this worker is about to retire
+        conn.send((bot_id, jobs >= max_jobs))
+    conn.close()
+
+
+class Worker:
+    def __init__(self, ctx, max_jobs):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=worker_main, args=(child_conn, max_jobs), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.bot_id = None
+        self.owner = None
+        self.bots = set()
+        self.retiring = False
+
+
+class WorkerPool:
+    """Long-lived trade workers that receive bot ids over a pipe.
+
+    Workers exit on their own after max_jobs dispatches and are replaced, and a
+    worker that dies mid-job is replaced after on_crash(bot_id, owner) is called.
+    """
+
+    def __init__(self, size, max_jobs, on_crash):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.on_crash = on_crash
+        self.ctx = multiprocessing.get_context('spawn')
+        self.lock = Lock()
+        self.workers = []
+
+    def start(self):
+        with self.lock:
+            self.workers = [Worker(self.ctx, self.max_jobs) for _ in range(self.size)]
+
+    def is_idle(self, worker):
+        return worker.bot_id is None and not worker.retiring and worker.process.is_alive()
+
+    def has_idle(self):
+        return any(self.is_idle(w) for w in self.workers)
+
+    def busy_bots(self):
+        return {w.bot_id for w in self.workers if w.bot_id is not None}
+
+    def submit(self, bot_id, owner):
+        # Prefer an idle worker that already holds a warm client for this bot
+        with self.lock:
+            idle = [w for w in self.workers if self.is_idle(w)]
+            if not idle:
+                return False
+            worker = next((w for w in idle if bot_id in w.bots), idle[0])
+            worker.bot_id = bot_id
+            worker.owner = owner
+            worker.bots.add(bot_id)
+            worker.conn.send((bot_id, owner))
+            return True
+
+    def collect(self, timeout):
+        # Wait for finished jobs or dead workers. Returns True when a worker became free.
+        ready = wait([w.conn for w in self.workers] + [w.process.sentinel for w in self.workers], timeout)
+        if not ready:
+            return False
+        freed = False
+        with self.lock:
+            for i, worker in enumerate(self.workers):
+                try:
+                    while worker.conn.poll():
+                        _, worker.retiring = worker.conn.recv()
+                        worker.bot_id = None
+                        freed = True
+                except (EOFError, OSError):
+                    pass
+                if not worker.process.is_alive():
+                    if worker.bot_id is not None:
+                        print(f"Worker crashed while running bot {worker.bot_id}.")
+                        self.on_crash(worker.bot_id, worker.owner)
+                    worker.conn.close()
+                    self.workers[i] = Worker(self.ctx, self.max_jobs)
+                    freed = True
+        return freed
+
+    def stop(self, timeout=30):
+        with self.lock:
+            for worker in self.workers:
+                try:
+                    worker.conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            for worker in self.workers:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            self.workers = []